@@ -59,11 +59,18 @@ def generate_tracks_with_global_caesar_and_bottleneck(num_tracks: int, base_segm
                         next_segments = [next_segment]
                 else:
                     next_segments = [start_segment_id]
-            segments.append({
+            segment = {
                 "segmentId": seg_id,
                 "type": seg_type,
                 "nextSegments": next_segments
-            })
+            }
+            if len(next_segments) > 1:
+                # An Verzweigungen wählt das Segment-Programm das Ziel mit dem kürzesten Stream.
+                segment["routing"] = "least-loaded"
+            if seg_type == "bottleneck":
+                # Bottlenecks nehmen nur ein Token gleichzeitig auf (verteilter Semaphor im Segment-Programm).
+                segment["capacity"] = 1
+            segments.append(segment)
 
         # Caesar-Rückführung
         caesar_ret_id = f"segment-{t}-caesar-ret"
@@ -112,6 +119,7 @@ def generate_tracks_with_global_caesar_and_bottleneck(num_tracks: int, base_segm
     global_bottleneck = {
         "segmentId": "segment-global-bottleneck",
         "type": "global-bottleneck",
+        "capacity": 1,
         "nextSegments": [f"segment-{t}-bottleneck-ret" for t in range(1, num_tracks + 1)]
     }
 
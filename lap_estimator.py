@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Monte-Carlo-Schätzung der Rundenzeiten aus tracks.json mit NumPy.
+
+Die Bearbeitungszeit jedes Segments ist gleichverteilt (DELAY_RANGE im Segment-Programm),
+die Rundenzeit hängt also nur von den möglichen Wegen durch den Track ab. Der Schätzer zählt
+alle Wege einer Runde (vom Start-und-Ziel-Segment zurück dorthin) mit ihren Wahrscheinlichkeiten
+auf und zieht dann Millionen von Runden in vektorisierten Batches: pro Batch eine Wegwahl je
+Runde und eine Matrix aus Segmentzeiten, die mit der Inzidenzmatrix der Wege maskiert wird.
+
+Warteschlangen und Kapazitäten bleiben unberücksichtigt (dafür gibt es race_simulator.py);
+least-loaded verteilt ohne Last wie Segment.route gleichmäßig auf alle Kandidaten (zufällige
+Wahl bei gleichem Rückstand).
+"""
+import argparse
+import re
+import time
+
+import numpy as np
+
+from race_manager import MAX_ROUNDS, collect_segments, load_tracks
+from segment_program import DELAY_RANGE
+from segment_worker import create_segments
+
+SAMPLES = 1_000_000
+BATCH_SIZE = 100_000
+PERCENTILES = (50, 90, 95, 99)
+
+def route_probabilities(segment, candidates):
+    """Wahrscheinlichkeit jedes Kandidaten gemäß der Routing-Strategie des Segments (ohne Last)."""
+    if len(candidates) == 1 or segment.routing == "first":
+        return [(candidates[0], 1.0)]
+    if segment.routing == "weighted":
+        total = sum(segment.weights.get(nxt, 1) for nxt in candidates)
+        return [(nxt, segment.weights.get(nxt, 1) / total) for nxt in candidates]
+    return [(nxt, 1.0 / len(candidates)) for nxt in candidates]
+
+def lap_paths(segments, start_segment, token):
+    """Alle Wege einer Runde ab start_segment als Liste von (Segmente, Wahrscheinlichkeit)."""
+    paths = []
+
+    def walk(segment_id, path, probability):
+        path = path + [segment_id]
+        segment = segments[segment_id]
+        for nxt, p in route_probabilities(segment, segment.route_candidates(token)):
+            if nxt == start_segment:
+                paths.append((path, probability * p))
+            elif nxt in path:
+                raise ValueError(f"Schleife ohne Start-und-Ziel-Segment: {' -> '.join(path + [nxt])}")
+            else:
+                walk(nxt, path, probability * p)
+
+    walk(start_segment, [], 1.0)
+    return paths
+
+def sample_laps(paths, samples, batch_size, rng):
+    """
+    Zieht samples Rundenzeiten in Batches. Gibt die Rundenzeiten, die Segmente und deren
+    mittleren Beitrag zu einer Runde (in Sekunden) zurück.
+    """
+    segment_ids = sorted({segment_id for path, _ in paths for segment_id in path})
+    column = {segment_id: i for i, segment_id in enumerate(segment_ids)}
+    incidence = np.zeros((len(paths), len(segment_ids)))
+    for row, (path, _) in enumerate(paths):
+        incidence[row, [column[segment_id] for segment_id in path]] = 1.0
+    probabilities = np.array([p for _, p in paths])
+    probabilities /= probabilities.sum()
+
+    laps = np.empty(samples)
+    contribution = np.zeros(len(segment_ids))
+    for offset in range(0, samples, batch_size):
+        n = min(batch_size, samples - offset)
+        chosen = rng.choice(len(paths), size=n, p=probabilities)
+        durations = rng.uniform(*DELAY_RANGE, size=(n, len(segment_ids))) * incidence[chosen]
+        laps[offset:offset + n] = durations.sum(axis=1)
+        contribution += durations.sum(axis=0)
+    return laps, segment_ids, contribution / samples
+
+def race_times(laps, rounds):
+    """Rennzeiten aus jeweils rounds aufeinanderfolgenden, unabhängigen Runden."""
+    usable = len(laps) // rounds * rounds
+    return laps[:usable].reshape(-1, rounds).sum(axis=1)
+
+def measured_results(path):
+    """Gesamtzeiten aus einer Ergebnisdatei im Format von save_results als {Token: Sekunden}."""
+    results = {}
+    token = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            match = re.match(r"Token (\S+):", line)
+            if match:
+                token = match.group(1)
+            match = re.match(r"\s+Gesamtzeit: ([0-9.]+) seconds", line)
+            if match and token:
+                results[token] = float(match.group(1))
+    return results
+
+def describe(values):
+    """Mittelwert, Standardabweichung, Perzentile, Minimum und Maximum als Text."""
+    percentiles = ", ".join(f"p{p} {v:.2f}" for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+    return (f"Mittel {values.mean():.2f}, Std {values.std():.2f}, {percentiles}, "
+            f"min {values.min():.2f}, max {values.max():.2f} Sekunden")
+
+def estimate(tracks_data, samples=SAMPLES, batch_size=BATCH_SIZE, rounds=MAX_ROUNDS, seed=None, measured=None):
+    """Schätzt für jeden Track Runden- und Rennzeiten und gibt sie samt Segmentbeiträgen aus."""
+    rng = np.random.default_rng(seed)
+    raw = collect_segments(tracks_data)
+    segments = {segment.segment_id: segment for segment in create_segments(None, raw, rounds, "estimator")}
+    for track in tracks_data.get("tracks", []):
+        start_segment = next(s["segmentId"] for s in track["segments"] if s.get("type") == "start-goal")
+        track_id = start_segment.split("-")[-1]
+        started = time.time()
+        paths = lap_paths(segments, start_segment, f"token-{track_id}-1")
+        laps, segment_ids, contribution = sample_laps(paths, samples, batch_size, rng)
+        races = race_times(laps, rounds)
+        print(f"Track {track_id}: {len(paths)} Rundenwege, {samples} Runden gezogen "
+              f"({time.time() - started:.2f} Sekunden)")
+        if len(paths) > 1:
+            for path, probability in sorted(paths, key=lambda p: -p[1]):
+                print(f"  Weg mit Wahrscheinlichkeit {probability:.1%}: {' -> '.join(path)}")
+        print(f"  Runde: {describe(laps)}")
+        print(f"  Rennen ({rounds} Runden): {describe(races)}")
+        print("  Beitrag pro Runde:")
+        for i in np.argsort(contribution)[::-1]:
+            print(f"    {segment_ids[i]}: {contribution[i]:.3f} Sekunden ({contribution[i] / laps.mean():.1%})")
+        for token, total in sorted((measured or {}).items()):
+            if token.split("-")[1] == track_id:
+                print(f"  Gemessen {token}: {total:.2f} Sekunden, Perzentil {(races < total).mean():.1%} "
+                      f"der geschätzten Rennzeiten")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Schätzt Runden- und Rennzeiten aus tracks.json per vektorisierter Monte-Carlo-Simulation."
+    )
+    parser.add_argument("--tracks", default="tracks.json", help="Streckenbeschreibung (Standard: 'tracks.json').")
+    parser.add_argument("--samples", type=int, default=SAMPLES, help=f"Gezogene Runden pro Track (Standard: {SAMPLES}).")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help=f"Runden pro vektorisiertem Batch (Standard: {BATCH_SIZE}).")
+    parser.add_argument("--rounds", type=int, default=MAX_ROUNDS, help=f"Runden pro Rennen (Standard: {MAX_ROUNDS}).")
+    parser.add_argument("--seed", type=int, default=None, help="Startwert des Zufallsgenerators (Standard: zufällig).")
+    parser.add_argument("--compare", default=None,
+                        help="Ergebnisdatei im Format von race_results.txt, deren Gesamtzeiten eingeordnet werden.")
+    args = parser.parse_args()
+
+    estimate(load_tracks(args.tracks), args.samples, args.batch_size, args.rounds, args.seed,
+             measured_results(args.compare) if args.compare else None)
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+"""
+In-Memory-Transport für das Segment-Programm: ein Broker im eigenen Prozess, der die vom
+Segment-Programm, vom Worker und vom Race-Manager benutzten Redis-Befehle (Streams mit
+Consumer Groups, Hashes, Listen, Strings mit Ablaufzeit, Sorted Sets für den Semaphor) mit
+Dicts und Listen nachbildet. Aufrufe und Antworten entsprechen dem redis-py-Client mit
+decode_responses=True, sodass Segment, TokenScheduler und run_worker unverändert laufen.
+
+Damit lassen sich ganze Rennen ohne Docker und Redis in einem Python-Prozess ausführen
+(siehe TRANSPORT im Race-Manager). Lua-Skripte werden nicht interpretiert: Für jedes
+bekannte Skript gibt es in SCRIPT_FUNCTIONS eine gleichwertige Python-Funktion.
+"""
+import fnmatch
+import hashlib
+import threading
+import time
+
+from segment_program import ACQUIRE_SCRIPT, RENEW_SCRIPT, NoScriptError, ResponseError
+
+NODE_NAME = "memory"  # Name des einzigen "Knotens" in info().
+EXPIRE_SWEEP_INTERVAL = 1.0  # Sekunden zwischen zwei Durchläufen über abgelaufene Keys.
+
+class _SortedSet(dict):
+    """Sorted Set als Dict Element -> Score (nur die Operationen des Semaphors)."""
+
+class _Stream:
+    """Einträge eines Streams (in ID-Reihenfolge) und seine Consumer Groups."""
+    def __init__(self):
+        self.entries = {}
+        self.last_id = (0, 0)
+        self.groups = {}
+
+class _Group:
+    """Consumer Group: zuletzt ausgelieferte ID und Pending Entries List (ID -> [Consumer, Zeitpunkt, Anzahl])."""
+    def __init__(self, last_delivered):
+        self.last_delivered = last_delivered
+        self.pending = {}
+
+def parse_id(entry_id, default_seq=0):
+    """Stream-ID ("<ms>-<seq>", "<ms>", "-" oder "+") als vergleichbares Tupel."""
+    if entry_id == "-":
+        return (0, 0)
+    if entry_id == "+":
+        return (float("inf"), float("inf"))
+    ms, _, seq = str(entry_id).partition("-")
+    return (int(ms), int(seq) if seq else default_seq)
+
+def format_id(id_tuple):
+    return f"{id_tuple[0]}-{id_tuple[1]}"
+
+def encode_value(value):
+    """Wert so, wie ihn Redis speichert und redis-py mit decode_responses=True zurückgibt."""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "surrogateescape")
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def human_bytes(size):
+    """Speichergröße im Format von used_memory_human."""
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024 or unit == "G":
+            return f"{size}B" if unit == "B" else f"{size:.2f}{unit}"
+        size /= 1024
+
+def acquire_lease_script(broker, keys, args):
+    """Python-Gegenstück zu ACQUIRE_SCRIPT (abgelaufene Leases entfernen, dann Platz belegen)."""
+    leases_key, capacity_key = keys
+    lease_id, ttl_ms = args
+    now = int(time.time() * 1000)
+    broker.zremrangebyscore(leases_key, "-inf", now)
+    capacity = int(broker.get(capacity_key) or 1)
+    if broker.zcard(leases_key) < capacity:
+        broker.zadd(leases_key, {lease_id: now + int(ttl_ms)})
+        return 1
+    return 0
+
+def renew_leases_script(broker, keys, args):
+    """Python-Gegenstück zu RENEW_SCRIPT (nur noch vorhandene Leases verlängern)."""
+    leases_key, = keys
+    ttl_ms, *lease_ids = args
+    expires = int(time.time() * 1000) + int(ttl_ms)
+    return broker.zadd(leases_key, {lease_id: expires for lease_id in lease_ids}, xx=True, ch=True)
+
+# Lua-Skript -> gleichwertige Python-Funktion(broker, keys, args).
+SCRIPT_FUNCTIONS = {
+    ACQUIRE_SCRIPT: acquire_lease_script,
+    RENEW_SCRIPT: renew_leases_script,
+}
+
+class MemoryPipeline:
+    """Sammelt Befehle wie eine (nicht transaktionale) redis-py-Pipeline und führt sie gemeinsam aus."""
+    def __init__(self, broker):
+        self.broker = broker
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.reset()
+
+    def __getattr__(self, name):
+        command = getattr(self.broker, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self, raise_on_error=True):
+        """Führt alle Befehle unter der Sperre des Brokers aus; Fehler wie bei redis-py."""
+        replies = []
+        with self.broker.condition:
+            for command, args, kwargs in self.commands:
+                try:
+                    replies.append(command(*args, **kwargs))
+                except ResponseError as e:
+                    replies.append(e)
+        self.reset()
+        if raise_on_error:
+            for reply in replies:
+                if isinstance(reply, ResponseError):
+                    raise reply
+        return replies
+
+class MemoryBroker:
+    """
+    Redis-Ersatz im Prozess. Alle Befehle laufen unter einer gemeinsamen Sperre; blockierende
+    Befehle (XREADGROUP mit block, BLPOP) warten auf die Condition, die jeder Schreibzugriff weckt.
+    """
+    def __init__(self):
+        self.condition = threading.Condition(threading.RLock())
+        self.data = {}
+        self.expires = {}
+        self.scripts = {}
+        self.peak_memory = 0
+        self.closed = False
+        self.next_expire_sweep = time.time() + EXPIRE_SWEEP_INTERVAL
+
+    def pipeline(self, transaction=False):
+        return MemoryPipeline(self)
+
+    # --- Keyspace ---
+
+    def _exists(self, name):
+        """Prüft, ob der Key existiert; abgelaufene Keys werden dabei entfernt."""
+        if name in self.expires and self.expires[name] <= time.time():
+            self._remove(name)
+        return name in self.data
+
+    def _value(self, name, kind, create=False):
+        """Wert eines Keys mit Typprüfung (None, falls er fehlt und create nicht gesetzt ist)."""
+        value = self.data.get(name) if self._exists(name) else None
+        if value is None:
+            if not create:
+                return None
+            value = self.data[name] = kind()
+        elif type(value) is not kind:
+            raise ResponseError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _remove(self, name):
+        self.expires.pop(name, None)
+        return self.data.pop(name, None) is not None
+
+    def _drop_if_empty(self, name):
+        # Wie Redis: leere Hashes, Listen und Sorted Sets verschwinden.
+        if not self.data.get(name):
+            self._remove(name)
+
+    def _sweep_expired(self):
+        now = time.time()
+        if now < self.next_expire_sweep:
+            return
+        self.next_expire_sweep = now + EXPIRE_SWEEP_INTERVAL
+        for name in [n for n, deadline in self.expires.items() if deadline <= now]:
+            self._remove(name)
+
+    def _wait(self, timeout):
+        """Wartet auf den nächsten Schreibzugriff; nach close() bricht jeder blockierende Befehl ab."""
+        if self.closed:
+            raise ResponseError("ERR Broker wurde geschlossen")
+        self.condition.wait(timeout)
+        if self.closed:
+            raise ResponseError("ERR Broker wurde geschlossen")
+
+    def close(self):
+        """Weckt alle blockierenden Befehle (z.B. auf Leases wartende Tokens), die daraufhin abbrechen."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def ping(self):
+        return True
+
+    def delete(self, *names):
+        with self.condition:
+            return sum(self._remove(name) for name in names)
+
+    def scan_iter(self, match=None, count=None):
+        """Alle Keys (optional nur die zum Glob-Muster match passenden) als Liste statt Cursor."""
+        with self.condition:
+            return [name for name in list(self.data) if self._exists(name)
+                    and (match is None or fnmatch.fnmatchcase(name, match))]
+
+    # --- Strings ---
+
+    def get(self, name):
+        with self.condition:
+            return self._value(name, str)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        with self.condition:
+            self._sweep_expired()
+            exists = self._exists(name)
+            if (nx and exists) or (xx and not exists):
+                return None
+            self.data[name] = encode_value(value)
+            self.expires.pop(name, None)
+            if ex is not None or px is not None:
+                self.expires[name] = time.time() + (ex if ex is not None else px / 1000)
+            return True
+
+    def incr(self, name, amount=1):
+        with self.condition:
+            value = int(self._value(name, str) or 0) + amount
+            self.data[name] = str(value)
+            return value
+
+    # --- Hashes ---
+
+    def hset(self, name, key, value):
+        with self.condition:
+            values = self._value(name, dict, create=True)
+            added = key not in values
+            values[key] = encode_value(value)
+            return int(added)
+
+    def hgetall(self, name):
+        with self.condition:
+            return dict(self._value(name, dict) or {})
+
+    # --- Listen ---
+
+    def rpush(self, name, *values):
+        with self.condition:
+            items = self._value(name, list, create=True)
+            items.extend(encode_value(v) for v in values)
+            self.condition.notify_all()
+            return len(items)
+
+    def lrange(self, name, start, end):
+        with self.condition:
+            items = self._value(name, list) or []
+            end = len(items) if end == -1 else end + 1 if end >= 0 else len(items) + end + 1
+            return items[start if start >= 0 else max(0, len(items) + start):end]
+
+    def ltrim(self, name, start, end):
+        with self.condition:
+            items = self._value(name, list)
+            if items is not None:
+                items[:] = items[start:len(items) if end == -1 else end + 1]
+                self._drop_if_empty(name)
+            return True
+
+    def blpop(self, keys, timeout=0):
+        """Entnimmt das erste Element der ersten nicht leeren Liste; wartet höchstens timeout Sekunden (0 = unbegrenzt)."""
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        deadline = time.time() + timeout if timeout else None
+        with self.condition:
+            while True:
+                for name in keys:
+                    items = self._value(name, list)
+                    if items:
+                        value = items.pop(0)
+                        self._drop_if_empty(name)
+                        return (name, value)
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._wait(remaining)
+
+    # --- Sorted Sets (Semaphor) ---
+
+    def zadd(self, name, mapping, xx=False, ch=False):
+        with self.condition:
+            if xx:
+                members = self._value(name, _SortedSet) or {}
+                mapping = {member: score for member, score in mapping.items() if member in members}
+            else:
+                members = self._value(name, _SortedSet, create=True)
+            changed = sum(member not in members or (ch and members[member] != float(score))
+                          for member, score in mapping.items())
+            members.update((member, float(score)) for member, score in mapping.items())
+            return changed
+
+    def zrem(self, name, *values):
+        with self.condition:
+            members = self._value(name, _SortedSet) or {}
+            removed = sum(members.pop(value, None) is not None for value in values)
+            self._drop_if_empty(name)
+            return removed
+
+    def zcard(self, name):
+        with self.condition:
+            return len(self._value(name, _SortedSet) or {})
+
+    def zremrangebyscore(self, name, min, max):
+        with self.condition:
+            members = self._value(name, _SortedSet) or {}
+            low, high = float(min), float(max)
+            expired = [member for member, score in members.items() if low <= score <= high]
+            for member in expired:
+                del members[member]
+            self._drop_if_empty(name)
+            return len(expired)
+
+    # --- Streams ---
+
+    def _stream(self, name):
+        stream = self._value(name, _Stream)
+        if stream is None:
+            raise ResponseError("ERR no such key")
+        return stream
+
+    def _group(self, name, groupname):
+        stream = self._value(name, _Stream)
+        if stream is None or groupname not in stream.groups:
+            raise ResponseError(f"NOGROUP No such key '{name}' or consumer group '{groupname}'")
+        return stream, stream.groups[groupname]
+
+    def xadd(self, name, fields, id="*", maxlen=None, approximate=True):
+        with self.condition:
+            stream = self._value(name, _Stream, create=True)
+            if id == "*":
+                ms = int(time.time() * 1000)
+                entry_id = (ms, 0) if ms > stream.last_id[0] else (stream.last_id[0], stream.last_id[1] + 1)
+            else:
+                entry_id = parse_id(id)
+                if entry_id <= stream.last_id:
+                    raise ResponseError("ERR The ID specified in XADD is equal or smaller than the target stream top item")
+            stream.last_id = entry_id
+            stream.entries[format_id(entry_id)] = {k: encode_value(v) for k, v in fields.items()}
+            if maxlen is not None:
+                # Ohne Radix-Baum gibt es keine Knotengrenzen: "~" kürzt hier genau. Die Einträge
+                # stehen in ID-Reihenfolge im Dict, es werden also nur die ältesten entfernt.
+                while len(stream.entries) > maxlen:
+                    del stream.entries[next(iter(stream.entries))]
+            self.condition.notify_all()
+            return format_id(entry_id)
+
+    def _trim(self, stream, drop):
+        removed = [entry_id for index, entry_id in enumerate(stream.entries) if drop(index, entry_id)]
+        for entry_id in removed:
+            del stream.entries[entry_id]
+        return len(removed)
+
+    def xlen(self, name):
+        with self.condition:
+            stream = self._value(name, _Stream)
+            return len(stream.entries) if stream else 0
+
+    def xgroup_create(self, name, groupname, id="$", mkstream=False):
+        with self.condition:
+            stream = self._value(name, _Stream, create=mkstream)
+            if stream is None:
+                raise ResponseError("ERR The XGROUP subcommand requires the key to exist")
+            if groupname in stream.groups:
+                raise ResponseError("BUSYGROUP Consumer Group name already exists")
+            stream.groups[groupname] = _Group(stream.last_id if id == "$" else parse_id(id))
+            return True
+
+    def xread(self, streams, count=None, block=None):
+        """Einträge nach der angegebenen ID ohne Consumer Group; mit block wird auf neue gewartet."""
+        deadline = time.time() + block / 1000 if block else None
+        with self.condition:
+            # "$" steht für den letzten Eintrag zum Zeitpunkt des Aufrufs.
+            positions = {}
+            for name, last_id in streams.items():
+                stream = self._value(name, _Stream)
+                positions[name] = (stream.last_id if stream else (0, 0)) if last_id == "$" else parse_id(last_id)
+            while True:
+                result = []
+                for name, after in positions.items():
+                    stream = self._value(name, _Stream)
+                    if stream is None:
+                        continue
+                    ids = [i for i in stream.entries if parse_id(i) > after][:count]
+                    if ids:
+                        result.append([name, [(i, dict(stream.entries[i])) for i in ids]])
+                if result or block is None:
+                    return result
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return result
+                self._wait(remaining)
+
+    def xrevrange(self, name, max="+", min="-", count=None):
+        with self.condition:
+            stream = self._value(name, _Stream)
+            if stream is None:
+                return []
+            low, high = parse_id(min), parse_id(max, default_seq=float("inf"))
+            ids = [i for i in reversed(list(stream.entries)) if low <= parse_id(i) <= high][:count]
+            return [(i, dict(stream.entries[i])) for i in ids]
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        """Neue Einträge (ID ">") oder eigene unbestätigte Einträge ab der angegebenen ID."""
+        deadline = time.time() + block / 1000 if block else None
+        with self.condition:
+            while True:
+                result = []
+                for name, last_id in streams.items():
+                    stream, group = self._group(name, groupname)
+                    if last_id == ">":
+                        ids = [i for i in stream.entries if parse_id(i) > group.last_delivered][:count]
+                        if ids:
+                            group.last_delivered = parse_id(ids[-1])
+                        now = time.time()
+                        for entry_id in ids:
+                            if not noack:
+                                group.pending[entry_id] = [consumername, now, 1]
+                        entries = [(i, dict(stream.entries[i])) for i in ids]
+                    else:
+                        ids = [i for i, (consumer, _, _) in group.pending.items()
+                               if consumer == consumername and parse_id(i) > parse_id(last_id)]
+                        ids = sorted(ids, key=parse_id)[:count]
+                        entries = [(i, dict(stream.entries[i]) if i in stream.entries else None) for i in ids]
+                    if entries:
+                        result.append([name, entries])
+                if result or block is None or any(last_id != ">" for last_id in streams.values()):
+                    return result
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return result
+                self._wait(remaining)
+
+    def xack(self, name, groupname, *ids):
+        with self.condition:
+            _, group = self._group(name, groupname)
+            return sum(group.pending.pop(entry_id, None) is not None for entry_id in ids)
+
+    def xinfo_groups(self, name):
+        with self.condition:
+            stream = self._stream(name)
+            return [{"name": groupname, "consumers": len({p[0] for p in group.pending.values()}),
+                     "pending": len(group.pending), "last-delivered-id": format_id(group.last_delivered),
+                     "lag": sum(parse_id(i) > group.last_delivered for i in stream.entries)}
+                    for groupname, group in stream.groups.items()]
+
+    def xpending(self, name, groupname):
+        with self.condition:
+            _, group = self._group(name, groupname)
+            ids = sorted(group.pending, key=parse_id)
+            consumers = {}
+            for consumer, _, _ in group.pending.values():
+                consumers[consumer] = consumers.get(consumer, 0) + 1
+            return {"pending": len(ids), "min": ids[0] if ids else None, "max": ids[-1] if ids else None,
+                    "consumers": [{"name": c, "pending": n} for c, n in consumers.items()]}
+
+    def xpending_range(self, name, groupname, min, max, count, consumername=None):
+        with self.condition:
+            _, group = self._group(name, groupname)
+            low, high = parse_id(min), parse_id(max, default_seq=float("inf"))
+            now = time.time()
+            return [{"message_id": entry_id, "consumer": consumer,
+                     "time_since_delivered": int((now - delivered) * 1000), "times_delivered": times}
+                    for entry_id, (consumer, delivered, times) in sorted(group.pending.items(), key=lambda p: parse_id(p[0]))
+                    if low <= parse_id(entry_id) <= high and consumername in (None, consumer)][:count]
+
+    def xclaim(self, name, groupname, consumername, min_idle_time, message_ids):
+        """Übernimmt unbestätigte Einträge, die mindestens min_idle_time ms ruhen; gelöschte liefern (None, None)."""
+        with self.condition:
+            stream, group = self._group(name, groupname)
+            now = time.time()
+            claimed = []
+            for entry_id in message_ids:
+                pending = group.pending.get(entry_id)
+                if pending is None or (now - pending[1]) * 1000 < min_idle_time:
+                    continue
+                if entry_id not in stream.entries:
+                    del group.pending[entry_id]
+                    claimed.append((None, None))
+                    continue
+                group.pending[entry_id] = [consumername, now, pending[2] + 1]
+                claimed.append((entry_id, dict(stream.entries[entry_id])))
+            return claimed
+
+    def execute_command(self, *args):
+        """Nur XTRIM mit MAXLEN oder MINID (wie ihn das Segment-Programm direkt absetzt)."""
+        command, name, strategy, *rest = args
+        if command.upper() != "XTRIM":
+            raise ResponseError(f"ERR unknown command '{command}'")
+        threshold = rest[-1]
+        with self.condition:
+            stream = self._stream(name)
+            if strategy.upper() == "MINID":
+                minid = parse_id(threshold)
+                return self._trim(stream, lambda index, entry_id: parse_id(entry_id) < minid)
+            return self._trim(stream, lambda index, entry_id: index < len(stream.entries) - int(threshold))
+
+    # --- Skripte ---
+
+    def script_load(self, script):
+        """Registriert die Python-Entsprechung eines Lua-Skripts unter dessen SHA1 (wie SCRIPT LOAD)."""
+        if script not in SCRIPT_FUNCTIONS:
+            raise ResponseError("ERR Skript wird vom In-Memory-Transport nicht unterstützt")
+        sha = hashlib.sha1(script.encode()).hexdigest()
+        self.scripts[sha] = SCRIPT_FUNCTIONS[script]
+        return sha
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        if sha not in self.scripts:
+            raise NoScriptError("No matching script. Please use EVAL.")
+        with self.condition:
+            return self.scripts[sha](self, keys_and_args[:numkeys], keys_and_args[numkeys:])
+
+    # --- Server ---
+
+    def used_memory(self):
+        """Grobe Schätzung des belegten Speichers: Summe der Längen aller Keys und Werte."""
+        def size(value):
+            if isinstance(value, str):
+                return len(value)
+            if isinstance(value, _Stream):
+                return sum(len(i) + size(f) for i, f in value.entries.items()) + 64 * sum(
+                    len(g.pending) for g in value.groups.values())
+            if isinstance(value, dict):
+                return sum(len(k) + size(v) if isinstance(v, str) else len(k) + 8 for k, v in value.items())
+            return sum(len(v) for v in value)
+        return sum(len(name) + size(value) for name, value in self.data.items())
+
+    def info(self, section=None):
+        """
+        Wie INFO im Cluster: {Knoten: Abschnitt}; hier nur der Speicherabschnitt eines Knotens.
+        Die Spitze ist das Maximum der bisherigen Abfragen.
+        """
+        with self.condition:
+            used = self.used_memory()
+        self.peak_memory = max(self.peak_memory, used)
+        return {NODE_NAME: {"used_memory": used, "used_memory_human": human_bytes(used),
+                            "used_memory_peak": self.peak_memory,
+                            "used_memory_peak_human": human_bytes(self.peak_memory)}}
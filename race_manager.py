@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
+import asyncio
+import math
 import subprocess
+import shlex
+import threading
 import time
 import json
-from rediscluster import RedisCluster
+from concurrent.futures import ThreadPoolExecutor
+from segment_program import (GATED_SEGMENT_TYPES, Keyspace, create_client, decode_hop, default_capacity,
+                             encode_message, init_semaphore, track_of_segment)
+from segment_worker import WORKER_STATUS_KEY, create_segments, publish_control, run_worker
 
 # --- Statische Parameter / Konstanten ---
 BASE_PATH = "/home/sebi/SA4E_Ueb_3/CuCuCo"  # Basis-Verzeichnis für Konfigurationsdateien
@@ -11,11 +18,41 @@ REDIS_NODE_1_CONFIG = f"{REDIS_CONFIG_PATH}/redis-node-1.conf"
 REDIS_NODE_2_CONFIG = f"{REDIS_CONFIG_PATH}/redis-node-2.conf"
 REDIS_NODE_3_CONFIG = f"{REDIS_CONFIG_PATH}/redis-node-3.conf"
 NETWORK_NAME = "redis-cluster"  # Name des Docker-Netzwerks
+DOCKER_PARALLELISM = 32  # Gleichzeitig laufende Docker-Befehle beim Starten und Entfernen von Containern.
+REDIS_NODES = [("redis-node-1", 7001), ("redis-node-2", 7002), ("redis-node-3", 7003)]  # Container und Ports.
+CLUSTER_SLOTS = 16384  # Hash-Slots, die im fertigen Cluster zugewiesen und erreichbar sein müssen.
+BOOTSTRAP_TIMEOUT = 30  # Sekunden, die beim Hochfahren höchstens auf Knoten bzw. Cluster gewartet wird.
 
 # --- Globale Konfiguration ---
 TOKENS_PER_TRACK = 1   # Pro Track wird genau 1 Token gestartet.
 MAX_ROUNDS = 3
-MONITOR_DURATION = 30  # Dauer der Überwachung in Sekunden.
+RACE_TIMEOUT = 300  # Harte Obergrenze in Sekunden, falls nicht alle Tokens ins Ziel kommen.
+LOCATION_INTERVAL = 1.0  # Sekunden zwischen zwei Ausgaben der Token-Standorte (nur mit CLOCK_MODE "wall").
+# "wall" = reale Wartezeiten, "virtual" = beschleunigtes Rennen mit logischer Uhr. Die virtuellen
+# Laufzeiten sind nur eine Näherung (siehe TokenScheduler), genau rechnet race_simulator.py.
+CLOCK_MODE = "wall"
+SEGMENTS_PER_WORKER = 200  # Segmente pro asyncio-Worker-Container; 0 = ein Container pro Segment.
+# Globale Segmente erhalten alle Tokens aller Tracks: Sie laufen mit einer Replik pro angefangenen
+# TRACKS_PER_REPLICA Tracks (Feld "replicas" in tracks.json hat Vorrang, auch für andere Segmente).
+TRACKS_PER_REPLICA = 2
+KEY_LAYOUT = "track"  # Namensschema der Redis-Keys (siehe KEY_LAYOUTS im Segment-Programm).
+STATE_BUCKETS = 8  # Buckets pro Track für den Token-Zustand (verteilt die Schreiblast auf alle Knoten).
+KEYSPACE = Keyspace(KEY_LAYOUT, STATE_BUCKETS)
+PROJECT_STATE = True  # Runden, Startzeiten und Standorte der Tokens zusätzlich in Redis-Hashes mitschreiben.
+RECOVERY_IDLE = 60.0  # Sekunden, nach denen unbestätigte Tokens abgestürzter Segmente übernommen werden (0 = aus).
+MESSAGE_FORMAT = 1  # Format der Stream-Nachrichten und Segmentzeiten (2 = kompakt, siehe MESSAGE_FORMATS).
+# "redis" = Redis-Cluster und Segment-Container in Docker, "memory" = ganzes Rennen in diesem Prozess
+# mit dem In-Memory-Broker (siehe TRANSPORTS im Segment-Programm).
+TRANSPORT = "redis"
+TRIM_INTERVAL = 1.0  # Sekunden zwischen zwei XTRIM MINID ~ bis zum ältesten unbestätigten Eintrag (0 = aus).
+STREAM_MAXLEN = 0  # Ungefähre Obergrenze (MAXLEN ~) jedes Streams beim XADD (0 = keine).
+# Warmer Modus (nur mit SEGMENTS_PER_WORKER > 0): Cluster und Worker-Container bleiben nach dem
+# Rennen bestehen und werden beim nächsten Aufruf wiederverwendet. Jedes Rennen bekommt einen
+# eigenen Namensraum (RACE_PREFIX + Zeitstempel) für seine Keys, die Worker erhalten Segmente
+# und Einstellungen über den Steuer-Stream, und am Ende werden nur die Keys des Rennens gelöscht.
+WARM = False
+RACE_PREFIX = "race-"
+WARM_READY_TIMEOUT = 10  # Sekunden, die höchstens auf die Rückmeldung der warmen Worker gewartet wird.
 
 # --- Funktionen zur Rennverwaltung ---
 
@@ -33,31 +70,82 @@ def get_container_ip(container_name):
         print(f"Fehler beim Abrufen der IP von {container_name}: {e}")
         return None
 
+def run_docker_jobs(jobs, action):
+    """
+    Führt die Docker-Befehle vieler Container gleichzeitig aus (höchstens DOCKER_PARALLELISM).
+    jobs ist eine Liste von (Containername, [(Befehl, check), ...]); die Befehle eines Containers
+    laufen nacheinander, ein fehlgeschlagener Befehl mit check bricht dessen Job ab. Fehler werden
+    pro Container gesammelt und zusammen mit der Dauer ausgegeben.
+    Gibt die Namen der erfolgreich bearbeiteten Container in der Reihenfolge von jobs zurück.
+    """
+    def run(job):
+        _, commands = job
+        for cmd, check in commands:
+            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+            if check and result.returncode != 0:
+                return result.stderr.strip() or f"Exit-Code {result.returncode}"
+        return None
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=DOCKER_PARALLELISM) as executor:
+        errors = list(executor.map(run, jobs))
+    succeeded = []
+    for (name, _), error in zip(jobs, errors):
+        if error is None:
+            succeeded.append(name)
+        else:
+            print(f"Fehler bei {name}: {error}")
+    print(f"{action}: {len(succeeded)} von {len(jobs)} Containern in {time.time() - started:.2f} Sekunden.")
+    return succeeded
+
+def remove_stale_containers(container_names, names_per_command=100):
+    """Entfernt vorhandene Container mit diesen Namen vorab in wenigen Sammelbefehlen (fehlende werden ignoriert)."""
+    for i in range(0, len(container_names), names_per_command):
+        names = " ".join(container_names[i:i + names_per_command])
+        subprocess.run(f"docker rm -f {names}", shell=True, capture_output=True)
+
+def wait_until(probe, description, timeout=BOOTSTRAP_TIMEOUT, initial_delay=0.05, max_delay=1.0):
+    """
+    Ruft probe mit exponentiell wachsenden Pausen (initial_delay bis max_delay) auf, bis sie True
+    liefert, höchstens aber timeout Sekunden lang. Gibt zurück, ob der Zustand erreicht wurde.
+    """
+    started = time.time()
+    delay = initial_delay
+    while True:
+        if probe():
+            print(f"{description} nach {time.time() - started:.2f} Sekunden.")
+            return True
+        if time.time() - started + delay > timeout:
+            print(f"{description}: nach {timeout} Sekunden nicht erreicht.")
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def redis_cli(name, port, command):
+    """Führt einen redis-cli-Befehl im Container aus; gibt die Ausgabe zurück (None bei Fehlern)."""
+    result = subprocess.run(f"docker exec {name} redis-cli -p {port} {command}", shell=True,
+                            capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def redis_nodes_respond():
+    """Readiness-Probe: Jeder Redis-Knoten antwortet auf PING."""
+    return all(redis_cli(name, port, "ping") == "PONG" for name, port in REDIS_NODES)
+
 def reset_redis_cluster():
-    """Stoppt und entfernt alle Redis-Container, um das Cluster neu zu erstellen."""
-    redis_containers = ["redis-node-1", "redis-node-2", "redis-node-3"]
-    for name in redis_containers:
-        try:
-            subprocess.run(f"docker stop {name}", shell=True, check=True)
-            subprocess.run(f"docker rm {name}", shell=True, check=True)
-            print(f"Redis-Container {name} wurde gestoppt und entfernt (Reset).")
-        except subprocess.CalledProcessError as e:
-            print(f"Fehler beim Zurücksetzen von {name}: {e}")
-    time.sleep(2)
+    """Entfernt alle Redis-Container (inklusive Stoppen), um das Cluster neu zu erstellen."""
+    # "docker rm -f" kehrt erst zurück, wenn die Container entfernt sind: kein Warten nötig.
+    run_docker_jobs([(name, [(f"docker rm -f {name}", True)]) for name, _ in REDIS_NODES],
+                    "Redis-Container entfernt (Reset)")
 
 def start_redis_containers():
-    commands = [
-        f'docker run --name redis-node-1 --net {NETWORK_NAME} -v {REDIS_NODE_1_CONFIG}:/usr/local/etc/redis/redis.conf -p 7001:7001 -d redis redis-server /usr/local/etc/redis/redis.conf',
-        f'docker run --name redis-node-2 --net {NETWORK_NAME} -v {REDIS_NODE_2_CONFIG}:/usr/local/etc/redis/redis.conf -p 7002:7002 -d redis redis-server /usr/local/etc/redis/redis.conf',
-        f'docker run --name redis-node-3 --net {NETWORK_NAME} -v {REDIS_NODE_3_CONFIG}:/usr/local/etc/redis/redis.conf -p 7003:7003 -d redis redis-server /usr/local/etc/redis/redis.conf'
+    jobs = [
+        ("redis-node-1", [(f'docker run --name redis-node-1 --net {NETWORK_NAME} -v {REDIS_NODE_1_CONFIG}:/usr/local/etc/redis/redis.conf -p 7001:7001 -d redis redis-server /usr/local/etc/redis/redis.conf', True)]),
+        ("redis-node-2", [(f'docker run --name redis-node-2 --net {NETWORK_NAME} -v {REDIS_NODE_2_CONFIG}:/usr/local/etc/redis/redis.conf -p 7002:7002 -d redis redis-server /usr/local/etc/redis/redis.conf', True)]),
+        ("redis-node-3", [(f'docker run --name redis-node-3 --net {NETWORK_NAME} -v {REDIS_NODE_3_CONFIG}:/usr/local/etc/redis/redis.conf -p 7003:7003 -d redis redis-server /usr/local/etc/redis/redis.conf', True)]),
     ]
-    for cmd in commands:
-        try:
-            subprocess.run(cmd, shell=True, check=True)
-            print(f"Redis-Container gestartet: {cmd}")
-        except subprocess.CalledProcessError as e:
-            print(f"Befehl schlug fehl (evtl. existieren diese bereits): {cmd}")
-    time.sleep(5)
+    # Fehler bedeuten meist, dass die Container bereits existieren.
+    run_docker_jobs(jobs, "Redis-Container gestartet")
+    return wait_until(redis_nodes_respond, "Alle Redis-Knoten antworten auf PING")
 
 def is_container_running(container_name):
     try:
@@ -67,19 +155,27 @@ def is_container_running(container_name):
     except Exception:
         return False
 
-def check_redis_cluster():
-    try:
-        cmd = 'docker exec redis-node-1 redis-cli -p 7001 cluster info'
-        output = subprocess.check_output(cmd, shell=True).decode().strip()
-        if "cluster_state:ok" in output:
-            print("Redis-Cluster Status: cluster_state:ok")
-            return True
-        else:
-            print("Cluster Info:", output)
-            return False
-    except Exception as e:
-        print(f"Fehler bei der Cluster-Überprüfung: {e}")
-        return False
+def cluster_info(name, port):
+    """Felder von CLUSTER INFO eines Knotens als Dict (leer, wenn der Knoten nicht antwortet)."""
+    output = redis_cli(name, port, "cluster info") or ""
+    return dict(line.split(":", 1) for line in output.splitlines() if ":" in line)
+
+def check_redis_cluster(report=False):
+    """
+    Readiness-Probe für das Cluster: Jeder Knoten meldet cluster_state:ok und alle CLUSTER_SLOTS
+    Slots als zugewiesen und erreichbar. Mit report wird der Zustand jedes Knotens ausgegeben.
+    """
+    ready = True
+    for name, port in REDIS_NODES:
+        info = cluster_info(name, port)
+        node_ready = (info.get("cluster_state") == "ok"
+                      and info.get("cluster_slots_assigned") == str(CLUSTER_SLOTS)
+                      and info.get("cluster_slots_ok") == str(CLUSTER_SLOTS))
+        if report:
+            print(f"Cluster Info {name}: state {info.get('cluster_state')}, "
+                  f"Slots zugewiesen {info.get('cluster_slots_assigned')}, ok {info.get('cluster_slots_ok')}")
+        ready = ready and node_ready
+    return ready
 
 def create_redis_cluster():
     ip1 = get_container_ip("redis-node-1")
@@ -99,138 +195,519 @@ def create_redis_cluster():
         print(f"Fehler bei der Cluster-Erstellung: {e}")
         return False
 
-def start_segment_containers(tracks):
+def cluster_client():
+    """Client auf das laufende Redis-Cluster (Startknoten über die IP-Adressen der Container)."""
+    from rediscluster import RedisCluster
+    ip1 = get_container_ip("redis-node-1")
+    ip2 = get_container_ip("redis-node-2")
+    ip3 = get_container_ip("redis-node-3")
+    startup_nodes = [{"host": ip1, "port": 7001}, {"host": ip2, "port": 7002}, {"host": ip3, "port": 7003}]
+    print("Startup-Nodes:", startup_nodes)
+    return RedisCluster(startup_nodes=startup_nodes, decode_responses=True, encoding_errors="surrogateescape")
+
+def connect_cluster(reuse=False):
+    """
+    Erstellt den Redis-Cluster neu und gibt einen Client darauf zurück (None bei Fehlern).
+    Mit reuse wird ein laufendes Cluster weiterverwendet, sofern es alle Slots abdeckt und antwortet.
+    """
+    if reuse:
+        try:
+            # Der Client prüft beim Verbinden, dass alle Slots zugewiesen sind.
+            client = cluster_client()
+            client.ping()
+            print("Laufender Redis-Cluster wird wiederverwendet.")
+            return client
+        except Exception as e:
+            print(f"Kein laufender Redis-Cluster nutzbar ({e}), erstelle ihn neu.")
+    # Reset: Cluster neu erstellen
+    print("Setze bestehenden Redis-Cluster zurück...")
+    reset_redis_cluster()
+    print("Starte neuen Redis-Cluster...")
+    if not start_redis_containers():
+        print("Redis-Knoten sind nicht erreichbar. Programm wird beendet.")
+        return None
+    
+    if not create_redis_cluster():
+        print("Cluster-Erstellung fehlgeschlagen. Programm wird beendet.")
+        return None
+    if not wait_until(check_redis_cluster, f"Redis-Cluster bereit (cluster_state:ok, {CLUSTER_SLOTS} Slots)"):
+        check_redis_cluster(report=True)
+        print("Cluster funktioniert nach Neuerstellung nicht. Abbruch.")
+        return None
+
+    # Ermittele IP-Adressen und initialisiere den Redis-Cluster-Client.
+    return cluster_client()
+
+def collect_segments(tracks_data):
+    """Sammelt die Segmente aller Tracks sowie die globalen Segmente (z.B. segment-global-caesar)."""
+    segments = []
+    for track in tracks_data.get("tracks", []):
+        segments.extend(track.get("segments", []))
+    segments.extend(tracks_data.get("globalSegments", []))
+    return segments
+
+def track_ids(tracks):
+    """IDs aller Tracks aus tracks.json."""
+    return [track["trackId"] for track in tracks]
+
+def race_keys(tracks, name):
+    """Alle Keys name (z.B. "finished_tokens") des Rennens über alle Tracks und Buckets (ohne Duplikate)."""
+    return sorted({key for track_id in track_ids(tracks) for key in KEYSPACE.race_keys(track_id, name)})
+
+def finished_tokens(client, tracks):
+    """Summe der fertigen Tokens über alle Tracks und Buckets (in einer Pipeline gelesen)."""
+    pipe = client.pipeline()
+    for key in race_keys(tracks, "finished_tokens"):
+        pipe.get(key)
+    return sum(int(val or 0) for val in pipe.execute())
+
+def segment_capacity(seg):
+    """Kapazität eines Segments: Feld "capacity" aus tracks.json oder Standardwert des Typs."""
+    return seg.get("capacity") or default_capacity(seg.get("type", "normal"))
+
+def gated_segments(segments):
+    """
+    Alle Segmente mit Zulassungskontrolle: die Typen aus GATED_SEGMENT_TYPES im Segment-Programm
+    sowie jedes Segment, für das in tracks.json eine Kapazität angegeben ist.
+    """
+    return [seg for seg in segments if seg.get("type") in GATED_SEGMENT_TYPES or seg.get("capacity")]
+
+def annotate_gated_next(segments):
+    """Ergänzt jedes Segment um "gatedNext": die nächsten Segmente, die eine Lease verlangen."""
+    gated_ids = {seg["segmentId"] for seg in gated_segments(segments)}
+    return [dict(seg, gatedNext=[nxt for nxt in seg["nextSegments"] if nxt in gated_ids]) for seg in segments]
+
+def annotate_segment_index(segments):
+    """
+    Ergänzt jedes Segment um "index": seine Nummer in der Segmenttabelle (Reihenfolge von
+    collect_segments), über die kompakte Segmentzeiten das Segment referenzieren.
+    """
+    return [dict(seg, index=i) for i, seg in enumerate(segments)]
+
+def segment_replicas(seg, num_tracks):
+    """
+    Anzahl der Repliken eines Segments: "replicas" aus tracks.json oder die Heuristik für globale
+    Segmente. Segmente mit Zulassungskontrolle (gated_segments) laufen immer mit einer Replik:
+    Mehr Repliken brächten wegen des gemeinsamen Semaphors keinen Durchsatz, und im virtuellen
+    Modus (ohne Semaphor) hätte jede Replik ihre eigenen Plätze, die Kapazität wäre also vervielfacht.
     """
-    Startet für jedes Segment in allen Tracks einen Docker-Container,
+    if gated_segments([seg]):
+        if (seg.get("replicas") or 1) > 1:
+            print(f"Segment {seg['segmentId']} hat Zulassungskontrolle und läuft mit einer statt {seg['replicas']} Repliken.")
+        return 1
+    if seg.get("replicas"):
+        return seg["replicas"]
+    if track_of_segment(seg["segmentId"]) is None:
+        return max(1, math.ceil(num_tracks / TRACKS_PER_REPLICA))
+    return 1
+
+def expand_replicas(segments, num_tracks):
+    """
+    Liefert jedes Segment so oft, wie es Repliken hat (Feld "replica", ab 1). Alle Repliken lesen
+    über dieselbe Consumer Group aus demselben Stream, jeweils mit eigenem Consumer-Namen.
+    """
+    replicas = []
+    for seg in segments:
+        count = segment_replicas(seg, num_tracks)
+        if count > 1:
+            print(f"Segment {seg['segmentId']} läuft mit {count} Repliken.")
+        replicas.extend(dict(seg, replica=replica) for replica in range(1, count + 1))
+    return replicas
+
+def init_admission(client, segments):
+    """Setzt den verteilten Semaphor jedes Segments mit Zulassungskontrolle auf dessen Kapazität."""
+    for seg in gated_segments(segments):
+        init_semaphore(client, KEYSPACE, seg["segmentId"], segment_capacity(seg))
+        print(f"Zulassungskontrolle für {seg['segmentId']}: Kapazität {segment_capacity(seg)}.")
+
+def start_segment_containers(segments):
+    """
+    Startet für jedes Segment einen Docker-Container,
     der das Segment-Programm (Image 'segment') ausführt.
     Vor dem Start werden vorhandene Container mit demselben Namen entfernt.
+    Die Container werden parallel gestartet (siehe run_docker_jobs).
     """
-    container_names = []
-    for track in tracks:
-        for seg in track.get("segments", []):
-            seg_id = seg["segmentId"]
-            next_segs = seg["nextSegments"]
-            next_arg = ",".join(next_segs)
-            container_name = f"seg-{seg_id}"
-            try:
-                subprocess.run(f"docker rm -f {container_name}", shell=True, check=False)
-            except Exception:
-                pass
-            cmd = f"docker run --name {container_name} --net {NETWORK_NAME} -d segment --segment-id {seg_id} --next {next_arg} --redis-host redis-node-1 --redis-port 7001 --max-rounds {MAX_ROUNDS}"
-            try:
-                subprocess.run(cmd, shell=True, check=True)
-                print(f"Segment-Container gestartet: {container_name}")
-                container_names.append(container_name)
-            except subprocess.CalledProcessError as e:
-                print(f"Fehler beim Starten von {container_name}: {e}")
-    return container_names
+    jobs = []
+    for seg in segments:
+        seg_id = seg["segmentId"]
+        next_segs = seg["nextSegments"]
+        next_arg = ",".join(next_segs)
+        replica = seg.get("replica", 1)
+        container_name = f"seg-{seg_id}" if replica == 1 else f"seg-{seg_id}-r{replica}"
+        cmd = f"docker run --name {container_name} --net {NETWORK_NAME} -d segment --segment-id {seg_id} --next {next_arg} --segment-type {seg.get('type', 'normal')} --redis-host redis-node-1 --redis-port 7001 --max-rounds {MAX_ROUNDS} --clock {CLOCK_MODE} --key-layout {KEY_LAYOUT} --state-buckets {STATE_BUCKETS} --message-format {MESSAGE_FORMAT} --recovery-idle {RECOVERY_IDLE} --trim-interval {TRIM_INTERVAL} --stream-maxlen {STREAM_MAXLEN}"
+        if not PROJECT_STATE:
+            cmd += " --no-project-state"
+        if "index" in seg:
+            cmd += f" --segment-index {seg['index']}"
+        if seg.get("capacity"):
+            cmd += f" --capacity {seg['capacity']}"
+        if seg.get("gatedNext"):
+            cmd += f" --gated-next {','.join(seg['gatedNext'])}"
+        if seg.get("routing"):
+            cmd += f" --routing {seg['routing']}"
+        if seg.get("weights"):
+            cmd += f" --weights {','.join(str(w) for w in seg['weights'])}"
+        jobs.append((container_name, [(cmd, True)]))
+    remove_stale_containers([name for name, _ in jobs])
+    return run_docker_jobs(jobs, "Segment-Container gestartet")
 
-def stop_containers(container_names):
-    for name in container_names:
+def worker_chunks(segments, segments_per_worker):
+    """
+    Verteilt die Segmente auf Worker mit je bis zu segments_per_worker Segmenten; gibt eine Liste
+    von (Containername, Segmente) zurück. Repliken desselben Segments landen in verschiedenen
+    Workern (ein Consumer pro Worker).
+    """
+    chunks = []
+    for replica in sorted({seg.get("replica", 1) for seg in segments}):
+        group = [seg for seg in segments if seg.get("replica", 1) == replica]
+        prefix = "seg-worker" if replica == 1 else f"seg-worker-r{replica}"
+        for i in range(0, len(group), segments_per_worker):
+            chunks.append((f"{prefix}-{i // segments_per_worker + 1}", group[i:i + segments_per_worker]))
+    return chunks
+
+def start_segment_workers(segments, segments_per_worker):
+    """
+    Verteilt die Segmente auf asyncio-Worker (segment_worker.py im Image 'segment'),
+    von denen jeder bis zu segments_per_worker Segmente in einem Prozess betreibt (siehe worker_chunks).
+    """
+    jobs = []
+    for container_name, chunk in worker_chunks(segments, segments_per_worker):
+        segment_args = shlex.quote(json.dumps(chunk))
+        cmd = f"docker run --name {container_name} --net {NETWORK_NAME} -d --entrypoint python segment segment_worker.py --segments {segment_args} --redis-host redis-node-1 --redis-port 7001 --max-rounds {MAX_ROUNDS} --clock {CLOCK_MODE} --key-layout {KEY_LAYOUT} --state-buckets {STATE_BUCKETS} --message-format {MESSAGE_FORMAT} --recovery-idle {RECOVERY_IDLE} --trim-interval {TRIM_INTERVAL} --stream-maxlen {STREAM_MAXLEN}"
+        if not PROJECT_STATE:
+            cmd += " --no-project-state"
+        print(f"Worker-Container {container_name}: {len(chunk)} Segmente")
+        jobs.append((container_name, [(cmd, True)]))
+    remove_stale_containers([name for name, _ in jobs])
+    return run_docker_jobs(jobs, "Worker-Container gestartet")
+
+def running_containers():
+    """Namen aller laufenden Container (ein einziger "docker ps")."""
+    result = subprocess.run("docker ps --format '{{.Names}}'", shell=True, capture_output=True, text=True)
+    return set(result.stdout.split())
+
+def race_config(chunks):
+    """Start-Befehl für die warmen Worker: Segmente je Worker und die Einstellungen des Rennens."""
+    return {"segments": {name: chunk for name, chunk in chunks}, "max_rounds": MAX_ROUNDS, "clock": CLOCK_MODE,
+            "key_layout": KEY_LAYOUT, "state_buckets": STATE_BUCKETS, "project_state": PROJECT_STATE,
+            "message_format": MESSAGE_FORMAT, "recovery_idle": RECOVERY_IDLE, "trim_interval": TRIM_INTERVAL,
+            "stream_maxlen": STREAM_MAXLEN}
+
+def wait_for_workers(client, names, race, state):
+    """Wartet, bis alle Worker names für das Rennen den Zustand state gemeldet haben."""
+    expected = f"{race}:{state}"
+
+    def reported():
+        status = client.hgetall(WORKER_STATUS_KEY)
+        return all(status.get(name) == expected for name in names)
+    return wait_until(reported, f"{len(names)} warme Worker melden '{state}'", WARM_READY_TIMEOUT, initial_delay=0.01)
+
+def start_warm_workers(client, segments, segments_per_worker, race):
+    """
+    Verteilt die Segmente wie start_segment_workers, startet aber nur fehlende Worker-Container
+    (im warmen Modus, ohne Segmente) und teilt allen über den Steuer-Stream die Segmente und
+    Einstellungen des Rennens mit. Gibt die Namen der beteiligten Worker zurück, sobald diese
+    ihre Consumer Groups angelegt haben (None, wenn nicht alle rechtzeitig bereit sind).
+    """
+    chunks = worker_chunks(segments, segments_per_worker)
+    names = [name for name, _ in chunks]
+    running = running_containers()
+    missing = [name for name in names if name not in running]
+    if missing:
+        jobs = [(name, [(f"docker run --name {name} --net {NETWORK_NAME} -d --entrypoint python segment segment_worker.py --warm --consumer {name} --redis-host redis-node-1 --redis-port 7001", True)])
+                for name in missing]
+        remove_stale_containers(missing)
+        run_docker_jobs(jobs, "Warme Worker-Container gestartet")
+    print(f"Warme Worker: {len(names) - len(missing)} wiederverwendet, {len(missing)} neu gestartet.")
+    publish_control(client, race, "start", race_config(chunks))
+    if not wait_for_workers(client, names, race, "ready"):
+        # Bereits gestartete Worker geben das Rennen wieder auf; seine Keys entfernt das nächste Rennen.
+        publish_control(client, race, "stop")
+        return None
+    return names
+
+def flush_race_keys(client, keep=None, batch_size=500):
+    """
+    Löscht die Keys aller Rennen (Namensräume mit RACE_PREFIX) außer dem Rennen keep. Der
+    Steuer-Stream und andere Keys bleiben erhalten. Gibt die Anzahl gelöschter Keys zurück.
+    """
+    keys = [key for key in client.scan_iter(match=f"{RACE_PREFIX}*", count=1000)
+            if keep is None or not key.startswith(f"{keep}:")]
+    for i in range(0, len(keys), batch_size):
+        pipe = client.pipeline()
+        for key in keys[i:i + batch_size]:
+            pipe.delete(key)
+        pipe.execute()
+    return len(keys)
+
+def stop_warm_race(client, worker_names, race):
+    """Beendet das Rennen in den warmen Workern und löscht danach nur dessen Keys (Cluster und Worker laufen weiter)."""
+    publish_control(client, race, "stop")
+    wait_for_workers(client, worker_names, race, "stopped")
+    print(f"{flush_race_keys(client)} Keys des Rennens {race} gelöscht; Cluster und Worker laufen weiter.")
+
+def start_memory_workers(client, segments):
+    """
+    Betreibt alle Segmente im eigenen Prozess (Transport "memory"): pro Replik ein run_worker
+    mit eigenem Consumer-Namen, zusammen in einem Event-Loop in einem Hintergrund-Thread.
+    Gibt (Event-Loop, Task, Thread) für stop_memory_workers zurück.
+    """
+    groups = {}
+    for seg in segments:
+        groups.setdefault(seg.get("replica", 1), []).append(seg)
+    workers = [run_worker(client, create_segments(client, group, MAX_ROUNDS, f"memory-r{replica}", keyspace=KEYSPACE,
+                                                  project_state=PROJECT_STATE, message_format=MESSAGE_FORMAT,
+                                                  stream_maxlen=STREAM_MAXLEN),
+                          clock=CLOCK_MODE, recovery_idle=RECOVERY_IDLE, trim_interval=TRIM_INTERVAL)
+               for replica, group in sorted(groups.items())]
+    loop = asyncio.new_event_loop()
+
+    async def run_all():
+        await asyncio.gather(*workers)
+    task = loop.create_task(run_all())
+
+    def run():
+        asyncio.set_event_loop(loop)
         try:
-            subprocess.run(f"docker stop {name}", shell=True, check=True)
-            subprocess.run(f"docker rm {name}", shell=True, check=True)
-            print(f"Container {name} wurde gestoppt und entfernt.")
-        except subprocess.CalledProcessError as e:
-            print(f"Fehler beim Beenden von {name}: {e}")
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            # Wie asyncio.run: auch die noch auf Leases wartenden Tasks beenden.
+            pending = asyncio.all_tasks(loop)
+            for waiting in pending:
+                waiting.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            loop.close()
+    thread = threading.Thread(target=run, name="memory-workers", daemon=True)
+    thread.start()
+    return loop, task, thread
+
+def stop_memory_workers(client, workers):
+    """
+    Bricht die Worker von start_memory_workers ab und wartet auf das Ende ihres Event-Loops.
+    Das Schließen des Brokers beendet danach auch Threads, die noch auf eine Lease warten.
+    """
+    loop, task, thread = workers
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join()
+    client.close()
+
+def stop_containers(container_names):
+    """
+    Entfernt die Container parallel. "docker rm -f" beendet sie sofort, statt wie "docker stop"
+    bis zu zehn Sekunden pro Container auf das Ende des Prozesses zu warten.
+    """
+    run_docker_jobs([(name, [(f"docker rm -f {name}", True)]) for name in container_names],
+                    "Container gestoppt und entfernt")
 
 def start_race(start_segment_id, num_tokens, client):
     for token_id in range(1, num_tokens + 1):
         token = f"token-{start_segment_id.split('-')[-1]}-{token_id}"
-        client.xadd(f"stream-{start_segment_id}", {"token": token})
+        message = {"token": token}
+        if CLOCK_MODE == "virtual":
+            # Im virtuellen Modus starten alle Tokens zur virtuellen Zeit 0.
+            message["vt"] = 0
+        client.xadd(KEYSPACE.stream(start_segment_id), encode_message(message, MESSAGE_FORMAT))
         print(f"Token {token} gestartet in {start_segment_id}.")
 
-def monitor_token_locations(client, duration):
-    """Gibt für die angegebene Dauer (in Sekunden) wiederholt den aktuellen Redis-Hash 'token_locations' aus."""
-    start_time = time.time()
-    print("Überwache die aktuellen Token-Standorte ...")
-    while time.time() - start_time < duration:
+class LocationFeed:
+    """
+    Lokale Sicht der Token-Standorte aus den Standort-Streams aller Tracks. poll liest per XREAD
+    (in einer Pipeline) nur die Ereignisse nach der jeweils zuletzt gelesenen ID, der Aufwand
+    hängt also von der Zahl der Standortänderungen ab, nicht von der Zahl der Tokens.
+    """
+    def __init__(self, client, tracks, count=1000):
+        self.client = client
+        self.count = count
+        self.last_ids = {stream: "0-0" for stream in
+                         sorted({KEYSPACE.location_stream(track_id) for track_id in track_ids(tracks)})}
+        self.locations = {}
+
+    def poll(self):
+        """Übernimmt alle neuen Standortänderungen und gibt sie als {Token: Segment} zurück."""
+        changes = {}
+        while True:
+            pipe = self.client.pipeline()
+            for stream, last_id in self.last_ids.items():
+                pipe.xread({stream: last_id}, count=self.count)
+            read = 0
+            for stream, reply in zip(list(self.last_ids), pipe.execute()):
+                for _, entries in reply or []:
+                    for entry_id, fields in entries:
+                        self.last_ids[stream] = entry_id
+                        changes[fields["token"]] = fields["segment"]
+                        read += 1
+            # Volle Antworten: Es können noch weitere Ereignisse vorliegen.
+            if read < self.count:
+                break
+        self.locations.update(changes)
+        return changes
+
+    def report(self):
+        """Liest die neuen Standortänderungen und gibt nur diese aus."""
         try:
-            locations = client.hgetall("token_locations")
+            changes = self.poll()
         except Exception as e:
-            locations = {"Error": str(e)}
-        print("Aktuelle Token-Standorte:", locations)
-        time.sleep(1)
+            print(f"Fehler beim Lesen der Standortänderungen: {e}")
+            return
+        print(f"Neue Token-Standorte ({len(changes)} Änderungen, {len(self.locations)} Tokens bekannt):", changes)
 
-def race_finished(client, total_tokens):
+def wait_for_finish(client, tracks, total_tokens, timeout, show_locations=False, block=LOCATION_INTERVAL):
     """
-    Prüft, ob der Redis-Key "finished_tokens" mindestens den Wert total_tokens erreicht hat.
+    Wartet blockierend auf dem Finish-Stream (XREAD ab der zuletzt gelesenen ID), bis total_tokens
+    verschiedene Tokens das Ziel erreicht haben, höchstens aber timeout Sekunden. Mit
+    show_locations werden zwischendurch etwa alle block Sekunden die geänderten Token-Standorte
+    ausgegeben (siehe LocationFeed).
+    Gibt {Token: Gesamtzeit} der fertigen Tokens zurück.
     """
+    start_time = time.time()
+    stream = KEYSPACE.finish_stream()
+    last_id = "0-0"
+    finished = {}
+    next_report = start_time + block
+    feed = LocationFeed(client, tracks) if show_locations else None
+    print(f"Warte auf {total_tokens} Tokens im Ziel (höchstens {timeout} Sekunden) ...")
+    while len(finished) < total_tokens:
+        now = time.time()
+        remaining = timeout - (now - start_time)
+        if remaining <= 0:
+            print(f"Rennen nach {timeout} Sekunden abgebrochen: {len(finished)} von {total_tokens} Tokens im Ziel.")
+            return finished
+        if show_locations and now >= next_report:
+            next_report = now + block
+            feed.report()
+        wait = min(remaining, next_report - now if show_locations else block)
+        try:
+            reply = client.xread({stream: last_id}, block=max(1, int(wait * 1000)))
+        except Exception as e:
+            print(f"Fehler beim Lesen des Finish-Streams: {e}")
+            time.sleep(min(wait, block))
+            continue
+        for _, entries in reply or []:
+            for entry_id, fields in entries:
+                last_id = entry_id
+                # Doppelte Zustellungen (z.B. nach einer Übernahme) zählen nur einmal.
+                if fields["token"] not in finished:
+                    finished[fields["token"]] = float(fields["runtime"])
+                    print(f"Token {fields['token']} im Ziel ({len(finished)}/{total_tokens}).")
+    print(f"Rennen nach {time.time() - start_time:.3f} Sekunden Echtzeit beendet.")
+    return finished
+
+def print_routing_metrics(client):
+    """Gibt die Kennzahlen der least-loaded-Lastsicht aller Consumer aus."""
     try:
-        val = client.get("finished_tokens")
-        if val is None:
-            return False
-        return int(val) >= total_tokens
+        metrics = client.hgetall(KEYSPACE.routing_metrics())
     except Exception as e:
-        print(f"Fehler bei der Überprüfung des Rennstatus: {e}")
-        return False
+        print(f"Fehler beim Abrufen der Routing-Kennzahlen: {e}")
+        return
+    for field in sorted(metrics):
+        print(f"Routing-Kennzahl {field} = {metrics[field]}")
+
+def print_memory_usage(client):
+    """Gibt den aktuellen und den höchsten Speicherverbrauch jedes Cluster-Knotens aus."""
+    try:
+        memory = client.info("memory")
+    except Exception as e:
+        print(f"Fehler beim Abrufen des Speicherverbrauchs: {e}")
+        return
+    for node in sorted(memory):
+        info = memory[node]
+        print(f"Speicher {node}: {info.get('used_memory_human')} (Spitze {info.get('used_memory_peak_human')})")
 
-def save_results(client, tracks):
+def write_results(results, path="race_results.txt"):
     """
-    Liest für jedes Token (basierend auf dem Startsegment) die Redis-Liste 'race_results:<token>',
+    Schreibt Segmentzeiten und Gesamtzeit je Token in die Ergebnisdatei. results ist eine Liste
+    von (Token, [(Segment, Sekunden), ...]); nicht lesbare Einträge haben None als Sekunden.
+    """
+    with open(path, "w") as f:
+        for token, hops in results:
+            f.write(f"Token {token}:\n")
+            total_time = 0.0
+            for segment, duration in hops:
+                if duration is None:
+                    f.write(f"  Fehler beim Parsen von: {segment}\n")
+                    continue
+                total_time += duration
+                f.write(f"  {segment}: {duration:.6f} seconds\n")
+            f.write(f"  Gesamtzeit: {total_time:.6f} seconds\n\n")
+
+def save_results(client, tracks, segment_table):
+    """
+    Liest für jedes Token (basierend auf dem Startsegment) die Redis-Liste seiner Segmentzeiten,
     summiert die einzelnen Segmentzeiten und schreibt die Ergebnisse (Segmentzeiten und Gesamtzeit)
     in 'race_results.txt'.
     """
     try:
-        with open("race_results.txt", "w") as f:
-            for track in tracks:
-                start_segment = None
-                for s in track.get("segments", []):
-                    if s.get("type") == "start-goal":
-                        start_segment = s.get("segmentId")
-                        break
-                if start_segment:
-                    token_id = start_segment.split('-')[-1]
-                    token = f"token-{token_id}-1"
-                    results_list = client.lrange(f"race_results:{token}", 0, -1)
-                    f.write(f"Token {token}:\n")
-                    total_time = 0.0
-                    for item in results_list:
-                        try:
-                            segment, duration = item.split(":")
-                            duration = float(duration)
-                            total_time += duration
-                            f.write(f"  {segment}: {duration:.6f} seconds\n")
-                        except Exception as ex:
-                            f.write(f"  Fehler beim Parsen von: {item}\n")
-                    f.write(f"  Gesamtzeit: {total_time:.6f} seconds\n\n")
+        results = []
+        for track in tracks:
+            start_segment = None
+            for s in track.get("segments", []):
+                if s.get("type") == "start-goal":
+                    start_segment = s.get("segmentId")
+                    break
+            if start_segment:
+                token_id = start_segment.split('-')[-1]
+                token = f"token-{token_id}-1"
+                hops = []
+                for item in client.lrange(KEYSPACE.segment_times(token), 0, -1):
+                    try:
+                        hops.append(decode_hop(item, segment_table))
+                    except Exception:
+                        hops.append((item, None))
+                results.append((token, hops))
+        write_results(results)
         print("Rennergebnisse gespeichert.")
     except Exception as e:
         print(f"Fehler beim Speichern der Ergebnisse: {e}")
 
 def main():
-    # Reset: Cluster neu erstellen
-    print("Setze bestehenden Redis-Cluster zurück...")
-    reset_redis_cluster()
-    print("Starte neuen Redis-Cluster...")
-    start_redis_containers()
-    
-    if not create_redis_cluster():
-        print("Cluster-Erstellung fehlgeschlagen. Programm wird beendet.")
-        return
-    time.sleep(5)
-    if not check_redis_cluster():
-        print("Cluster funktioniert nach Neuerstellung nicht. Abbruch.")
-        return
-
-    # Ermittele IP-Adressen und initialisiere den Redis-Cluster-Client.
-    ip1 = get_container_ip("redis-node-1")
-    ip2 = get_container_ip("redis-node-2")
-    ip3 = get_container_ip("redis-node-3")
-    startup_nodes = [{"host": ip1, "port": 7001}, {"host": ip2, "port": 7002}, {"host": ip3, "port": 7003}]
-    print("Startup-Nodes:", startup_nodes)
-    client = RedisCluster(startup_nodes=startup_nodes, decode_responses=True)
-    
-    # Setze finished_tokens vor Beginn auf 0.
-    client.set("finished_tokens", 0)
+    global KEYSPACE
+    setup_started = time.time()
+    warm = WARM and TRANSPORT == "redis" and SEGMENTS_PER_WORKER > 0
+    if warm:
+        # Eigener Namensraum pro Rennen: Keys früherer Rennen stören nicht und werden gezielt gelöscht.
+        race = f"{RACE_PREFIX}{int(time.time() * 1000)}"
+        KEYSPACE = Keyspace(KEY_LAYOUT, STATE_BUCKETS, race)
+        print(f"Warmer Modus: Rennen {race}.")
+    if TRANSPORT == "memory":
+        # Ganzes Rennen in diesem Prozess: kein Docker, kein Redis-Cluster.
+        client = create_client(None, None, TRANSPORT)
+    else:
+        client = connect_cluster(reuse=warm)
+        if client is None:
+            return
+    if warm:
+        # Reste abgebrochener Rennen entfernen.
+        removed = flush_race_keys(client, keep=race)
+        if removed:
+            print(f"{removed} Keys früherer Rennen gelöscht.")
     
     # Lade die Streckenbeschreibung aus der JSON-Datei.
     tracks_data = load_tracks("tracks.json")
     tracks = tracks_data.get("tracks", [])
     print("Geladene Streckendaten:", tracks)
     
-    # Starte für jedes Segment aller Tracks einen eigenen Segment-Container.
-    segment_container_names = start_segment_containers(tracks)
+    # Setze finished_tokens (alle Buckets) vor Beginn auf 0.
+    for key in race_keys(tracks, "finished_tokens"):
+        client.set(key, 0)
+    
+    # Starte die Segmente aller Tracks (inklusive der globalen Segmente), entweder gebündelt
+    # in asyncio-Workern oder mit einem eigenen Container pro Segment.
+    segments = annotate_segment_index(annotate_gated_next(collect_segments(tracks_data)))
+    init_admission(client, segments)
+    replicas = expand_replicas(segments, len(tracks))
+    if TRANSPORT == "memory":
+        memory_workers = start_memory_workers(client, replicas)
+    elif warm:
+        segment_container_names = start_warm_workers(client, replicas, SEGMENTS_PER_WORKER, race)
+        if segment_container_names is None:
+            print("Warme Worker sind nicht bereit. Programm wird beendet.")
+            return
+    elif SEGMENTS_PER_WORKER > 0:
+        segment_container_names = start_segment_workers(replicas, SEGMENTS_PER_WORKER)
+    else:
+        segment_container_names = start_segment_containers(replicas)
+    print(f"Aufbau des Rennens (Cluster und Segmente) dauerte {time.time() - setup_started:.2f} Sekunden.")
     
     # Pro Track: Bestimme das Startsegment (Typ "start-goal") und starte dort ein Token.
     total_tokens = len(tracks) * TOKENS_PER_TRACK
@@ -243,15 +720,25 @@ def main():
         if start_segment:
             start_race(start_segment, TOKENS_PER_TRACK, client)
     
-    # Überwache für MONITOR_DURATION Sekunden die aktuellen Token-Standorte.
-    monitor_token_locations(client, MONITOR_DURATION)
+    # Bis alle Tokens im Ziel sind (höchstens RACE_TIMEOUT); mit realer Uhr die Standorte mit ausgeben.
+    wait_for_finish(client, tracks, total_tokens, RACE_TIMEOUT, show_locations=(CLOCK_MODE == "wall"))
     
-    # Nach der Überwachung: Gib den finalen Wert von finished_tokens aus.
-    finished = client.get("finished_tokens")
+    # Nach dem Rennen: Gib den finalen Wert von finished_tokens aus.
+    finished = finished_tokens(client, tracks)
     print(f"Rennstatus final: finished_tokens = {finished} (Erwartet: {total_tokens})")
     
+    print_routing_metrics(client)
+    print_memory_usage(client)
+    
     # Speichere die Rennergebnisse.
-    save_results(client, tracks)
+    save_results(client, tracks, [seg["segmentId"] for seg in segments])
+    
+    if TRANSPORT == "memory":
+        stop_memory_workers(client, memory_workers)
+        return
+    if warm:
+        stop_warm_race(client, segment_container_names, race)
+        return
     
     # Beende und entferne alle Segment-Container.
     stop_containers(segment_container_names)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Diskrete Ereignissimulation eines Rennens aus tracks.json (inklusive globalSegments), ohne
+Redis und ohne Docker. Statt zu schlafen arbeitet der Simulator eine nach Zeit geordnete
+Ereignis-Queue (Heap) ab: Jedes Ereignis ist das Ende der Bearbeitung eines Tokens in einem Segment.
+
+Nachgebildet wird das Verhalten des Segment-Programms:
+- Bearbeitungszeit pro Segment aus random_delay (wie im Segment-Programm),
+- Kapazität pro Segment und Replik (segment_capacity, segment_replicas), wartende Tokens
+  bleiben wie im Stream in einer FIFO-Warteschlange,
+- Zulassungskontrolle: Vor einem Segment mit Semaphor wartet das Token im vorherigen Segment
+  und belegt dort weiter seinen Platz, bis eine Lease frei ist,
+- Routing über Segment.route und Segment.route_candidates (least-loaded mit exaktem Rückstand),
+- Rundenzählung im Start-und-Ziel-Segment wie Segment.enter.
+
+Die Segmentzeiten werden im Format von race_manager.save_results geschrieben.
+"""
+import argparse
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+
+from race_manager import (MAX_ROUNDS, TOKENS_PER_TRACK, annotate_gated_next, collect_segments, gated_segments,
+                          load_tracks, segment_capacity, segment_replicas, write_results)
+from segment_program import random_delay, track_of_token
+from segment_worker import create_segments
+
+RESULTS_FILE = "simulation_results.txt"
+RECORDED_TOKENS = 1  # Tokens pro Track, deren Segmentzeiten geschrieben werden (wie save_results).
+
+class SegmentState:
+    """Zustand eines Segments in der Simulation: belegte Plätze, Warteschlangen und Statistik."""
+    def __init__(self, segment, capacity, gated):
+        self.segment = segment
+        self.segment_id = segment.segment_id
+        self.capacity = capacity
+        self.busy = 0
+        # Eingetroffene, aber noch nicht aufgenommene Tokens (entspricht dem Stream-Rückstand).
+        self.queue = deque()
+        # Semaphor: belegte Leases und Tokens, die im vorherigen Segment auf eine Lease warten.
+        self.gated = gated
+        self.leases = 0
+        self.admission = deque()
+        self.candidates = {}
+        self.processed = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.max_queue = 0
+
+    def backlog(self):
+        """Rückstand wie ihn least-loaded sieht: wartende und bearbeitete Tokens."""
+        return len(self.queue) + self.busy
+
+class RaceSimulation:
+    """Ereignisgesteuerte Simulation aller Tokens eines Rennens."""
+    def __init__(self, tracks_data, tokens_per_track=TOKENS_PER_TRACK, max_rounds=MAX_ROUNDS,
+                 recorded_tokens=RECORDED_TOKENS):
+        tracks = tracks_data.get("tracks", [])
+        raw = annotate_gated_next(collect_segments(tracks_data))
+        gated_ids = {seg["segmentId"] for seg in gated_segments(raw)}
+        self.segments = {}
+        for seg, segment in zip(raw, create_segments(None, raw, max_rounds, "simulator")):
+            gated = seg["segmentId"] in gated_ids
+            # Jede Replik nimmt bis zur Kapazität auf (Segmente mit Semaphor haben immer nur eine Replik).
+            capacity = segment_capacity(seg) * segment_replicas(seg, len(tracks))
+            self.segments[seg["segmentId"]] = SegmentState(segment, capacity, gated)
+        self.max_rounds = max_rounds
+        self.events = []
+        self.sequence = itertools.count()
+        self.tokens = []
+        self.runtimes = []
+        for track in tracks:
+            start_segment = next(s["segmentId"] for s in track["segments"] if s.get("type") == "start-goal")
+            for n in range(1, tokens_per_track + 1):
+                self.tokens.append((f"token-{start_segment.split('-')[-1]}-{n}", start_segment))
+        self.token_tracks = [track_of_token(name) for name, _ in self.tokens]
+        self.rounds = [0] * len(self.tokens)
+        self.starts = [None] * len(self.tokens)
+        self.arrivals = [0.0] * len(self.tokens)
+        self.hops = [[] if int(name.rsplit("-", 1)[1]) <= recorded_tokens else None for name, _ in self.tokens]
+
+    def run(self):
+        """Startet alle Tokens zum Zeitpunkt 0 und arbeitet die Ereignisse ab; gibt die Rennzeit zurück."""
+        for token, (_, start_segment) in enumerate(self.tokens):
+            self.arrive(token, self.segments[start_segment], 0.0)
+        now = 0.0
+        events = self.events
+        while events:
+            now, _, token, state, duration = heapq.heappop(events)
+            self.complete(token, state, duration, now)
+        return now
+
+    def arrive(self, token, state, now):
+        """Token trifft im Segment ein: sofort aufnehmen oder hinten anstellen."""
+        if state.busy < state.capacity:
+            self.admit(token, state, now)
+        else:
+            self.arrivals[token] = now
+            state.queue.append(token)
+            state.max_queue = max(state.max_queue, len(state.queue))
+
+    def admit(self, token, state, now):
+        """Nimmt das Token auf (Rundenwechsel im Start-und-Ziel-Segment) und plant das Bearbeitungsende."""
+        if state.segment.is_start_goal:
+            self.rounds[token] += 1
+            if self.starts[token] is None:
+                self.starts[token] = now
+            if self.rounds[token] > self.max_rounds:
+                self.runtimes.append(now - self.starts[token])
+                self.release_lease(state, now)
+                return
+        state.busy += 1
+        duration = random_delay()
+        state.processed += 1
+        state.busy_time += duration
+        heapq.heappush(self.events, (now + duration, next(self.sequence), token, state, duration))
+
+    def complete(self, token, state, duration, now):
+        """Bearbeitung beendet: nächstes Segment wählen und weiterleiten (bei Semaphor erst mit Lease)."""
+        if self.hops[token] is not None:
+            self.hops[token].append((state.segment_id, duration))
+        track = self.token_tracks[token]
+        candidates = state.candidates.get(track)
+        if candidates is None:
+            candidates = state.candidates[track] = state.segment.route_candidates(self.tokens[token][0])
+        if len(candidates) == 1:
+            target = self.segments[candidates[0]]
+        else:
+            lengths = None
+            if state.segment.routing == "least-loaded":
+                lengths = {nxt: self.segments[nxt].backlog() for nxt in candidates}
+            target = self.segments[state.segment.route(candidates, lengths)]
+        if target.gated:
+            if target.leases >= target.capacity:
+                # Keine Lease frei: Das Token belegt weiter seinen Platz in diesem Segment.
+                target.admission.append((token, state, now))
+                return
+            target.leases += 1
+        self.move(token, state, target, now)
+
+    def move(self, token, state, target, now):
+        """Token verlässt state und trifft in target ein; der frei gewordene Platz geht an den nächsten Wartenden."""
+        state.busy -= 1
+        self.release_lease(state, now)
+        # Schleife, weil ein Token, das im Start-und-Ziel-Segment das Rennen beendet, keinen Platz belegt.
+        while state.queue and state.busy < state.capacity:
+            waiting = state.queue.popleft()
+            state.wait_time += now - self.arrivals[waiting]
+            self.admit(waiting, state, now)
+        self.arrive(token, target, now)
+
+    def release_lease(self, state, now):
+        """Gibt die Lease des Segments frei und lässt das nächste wartende Token ein."""
+        if not state.gated:
+            return
+        state.leases -= 1
+        if state.admission:
+            token, upstream, since = state.admission.popleft()
+            upstream.wait_time += now - since
+            state.leases += 1
+            self.move(token, upstream, state, now)
+
+    def results(self):
+        """Segmentzeiten der aufgezeichneten Tokens im Format von write_results."""
+        return [(name, hops) for (name, _), hops in zip(self.tokens, self.hops) if hops is not None]
+
+def percentile(values, fraction):
+    """Perzentil einer sortierten Liste (nächster Rang)."""
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+def print_summary(simulation, race_time, wall_time):
+    """Gibt Rennzeit, Laufzeiten der Tokens und die Auslastung der Segmente aus."""
+    runtimes = sorted(simulation.runtimes)
+    print(f"Simuliert: {len(runtimes)} von {len(simulation.tokens)} Tokens fertig, Rennzeit {race_time:.2f} Sekunden "
+          f"(Rechenzeit {wall_time:.2f} Sekunden).")
+    if runtimes:
+        print(f"Gesamtzeit pro Token: Mittel {sum(runtimes) / len(runtimes):.2f}, p50 {percentile(runtimes, 0.5):.2f}, "
+              f"p95 {percentile(runtimes, 0.95):.2f}, p99 {percentile(runtimes, 0.99):.2f}, max {runtimes[-1]:.2f} Sekunden")
+    print("Segment: bearbeitet, Auslastung, mittlere Wartezeit, längste Warteschlange")
+    for state in sorted(simulation.segments.values(), key=lambda s: s.wait_time, reverse=True):
+        utilization = state.busy_time / (state.capacity * race_time) if race_time else 0.0
+        wait = state.wait_time / state.processed if state.processed else 0.0
+        print(f"  {state.segment_id}: {state.processed}, {utilization:.1%}, {wait:.3f} s, {state.max_queue}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simuliert ein Rennen aus tracks.json ereignisgesteuert, ohne Redis und Docker."
+    )
+    parser.add_argument("--tracks", default="tracks.json", help="Streckenbeschreibung (Standard: 'tracks.json').")
+    parser.add_argument("--tokens-per-track", type=int, default=TOKENS_PER_TRACK,
+                        help=f"Gestartete Tokens pro Track (Standard: {TOKENS_PER_TRACK}).")
+    parser.add_argument("--max-rounds", type=int, default=MAX_ROUNDS,
+                        help=f"Runden, bevor ein Token als fertig gilt (Standard: {MAX_ROUNDS}).")
+    parser.add_argument("--seed", type=int, default=None, help="Startwert des Zufallsgenerators (Standard: zufällig).")
+    parser.add_argument("--recorded-tokens", type=int, default=RECORDED_TOKENS,
+                        help=f"Tokens pro Track, deren Segmentzeiten geschrieben werden (Standard: {RECORDED_TOKENS}).")
+    parser.add_argument("--output", default=RESULTS_FILE, help=f"Ergebnisdatei (Standard: '{RESULTS_FILE}').")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    simulation = RaceSimulation(load_tracks(args.tracks), args.tokens_per_track, args.max_rounds, args.recorded_tokens)
+    started = time.time()
+    race_time = simulation.run()
+    print_summary(simulation, race_time, time.time() - started)
+    write_results(simulation.results(), args.output)
+    print(f"Simulationsergebnisse gespeichert in {args.output}.")
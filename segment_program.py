@@ -1,75 +1,987 @@
 #!/usr/bin/env python3
 import argparse
+import heapq
+import itertools
+import socket
+import struct
+from collections import namedtuple
 import time
 import random
-from rediscluster import RedisCluster
+import uuid
+import zlib
+try:
+    from redis.exceptions import NoScriptError, ResponseError
+except ImportError:
+    # Ohne redis-py ist nur der In-Memory-Transport nutzbar; er wirft dieselben Fehlerklassen.
+    class ResponseError(Exception):
+        pass
 
-def process_segment(segment_id, next_segments, redis_host="redis", redis_port=6379, max_rounds=3):
-    # Erstelle einen cluster-fähigen Redis-Client.
+    class NoScriptError(ResponseError):
+        pass
+
+# Segmenttypen, die Tokens nur nacheinander bearbeiten (Kapazität 1).
+SERIAL_SEGMENT_TYPES = ("bottleneck", "global-bottleneck")
+DEFAULT_CAPACITY = 10  # Gleichzeitig bearbeitete Tokens in allen anderen Segmenten.
+DELAY_RANGE = (0.5, 2.0)  # Grenzen der gleichverteilten Bearbeitungszeit pro Segment in Sekunden.
+# Segmenttypen mit Zulassungskontrolle (zusätzlich jedes Segment mit "capacity" in tracks.json):
+# Ein Token wird erst dann an ein solches Segment weitergeleitet, wenn es eine Lease im
+# verteilten Semaphor des Segments erhalten hat. Das Segment gibt die Lease frei, sobald
+# das Token es wieder verlässt; stürzt ein Worker ab, läuft sie nach LEASE_TTL Sekunden ab.
+GATED_SEGMENT_TYPES = SERIAL_SEGMENT_TYPES
+LEASE_TTL = 30
+# Solange ein Token im Segment ist, wird seine Lease etwa alle lease_ttl / LEASE_RENEW_DIVISOR
+# Sekunden verlängert (siehe RENEW_SCRIPT), auch während es auf die Lease des nächsten Segments
+# wartet. Ablaufen kann eine Lease damit nur noch, wenn ihr Worker ausgefallen ist.
+LEASE_RENEW_DIVISOR = 3
+# Sekunden pro BLPOP-Runde, wenn beim Warten auf eine Lease zwischendurch abgebrochen oder
+# verlängert werden muss (siehe acquire_lease).
+LEASE_WAIT_ROUND = 1
+
+# Routing an Verzweigungen: Jedes Token folgt genau einem der nächsten Segmente.
+# "first": immer das erste, "random": zufällig, "weighted": zufällig nach "weights" aus tracks.json,
+# "least-loaded": das Segment mit dem kleinsten Rückstand (unbestätigte und ungelesene Einträge).
+ROUTING_POLICIES = ("first", "random", "weighted", "least-loaded")
+DEFAULT_ROUTING = "random"
+# Die Rückstände für "least-loaded" werden lokal zwischengespeichert und höchstens alle
+# LOAD_REFRESH_INTERVAL Sekunden neu gelesen. Ist die Sicht älter als LOAD_MAX_STALENESS
+# (z.B. weil der Cluster nicht erreichbar ist), wird stattdessen zufällig verteilt.
+LOAD_REFRESH_INTERVAL = 0.5
+LOAD_MAX_STALENESS = 5.0
+# Wiederherstellung nach Abstürzen: Einträge, die ein anderer Consumer länger als RECOVERY_IDLE
+# Sekunden nicht bestätigt hat, werden alle RECOVERY_INTERVAL Sekunden per XCLAIM übernommen
+# (0 = aus). Damit ein übernommenes Token nicht doppelt weiterfährt, belegt jede Zustellung
+# den Idempotenzschlüssel (Token, hops) für DELIVERY_TTL Sekunden; eine zweite Nachricht mit
+# demselben Fortschritt wird bestätigt und verworfen.
+RECOVERY_IDLE = 60.0
+RECOVERY_INTERVAL = 5.0
+DELIVERY_TTL = 600
+# Begrenzter Speicher der Streams: Bearbeitete Einträge werden nur bestätigt (XACK; XDEL würde
+# den Radix-Baum des Streams zerstückeln). Jedes Segment kürzt seinen Stream alle TRIM_INTERVAL
+# Sekunden per XTRIM MINID ~ bis zum ältesten noch unbestätigten Eintrag seiner Consumer Group.
+# STREAM_MAXLEN > 0 begrenzt zusätzlich jeden Stream beim XADD per MAXLEN ~ (auch gegen Einträge,
+# die nie gelesen werden); Vorsicht: dabei gehen auch ungelesene Einträge verloren.
+TRIM_INTERVAL = 1.0
+STREAM_MAXLEN = 0
+# Hash mit den Kennzahlen der Lastsicht aller Consumer (Felder "<consumer>:<kennzahl>").
+ROUTING_METRICS_KEY = "routing_metrics"
+# Stream, in den das Start-und-Ziel-Segment jedes fertige Token schreibt (ein Key für alle Tracks,
+# damit der Race-Manager mit einem blockierenden XREAD auf das Ende des Rennens warten kann).
+FINISH_STREAM = "finish_events"
+# Streams der Standortänderungen (einer pro Track, im Hash-Tag des Tracks): Jedes Segment
+# schreibt beim Empfang eines Tokens ein Ereignis, der Race-Manager liest nur die neuen.
+# Die Länge wird beim XADD ungefähr auf LOCATION_STREAM_MAXLEN begrenzt.
+LOCATION_STREAM = "location_events"
+LOCATION_STREAM_MAXLEN = 10000
+
+# "wall": reale Wartezeiten; "virtual": logische Uhr, die mit den Nachrichten weitergereicht wird.
+# Der virtuelle Modus ist eine Näherung für schnelle Durchläufe (siehe TokenScheduler); genaue
+# Ergebnisse in virtueller Zeit liefert race_simulator.py.
+CLOCK_MODES = ("wall", "virtual")
+
+# Transport der Redis-Befehle (siehe create_client): "redis" = Redis-Cluster, "memory" = In-Memory-Broker
+# im selben Prozess (memory_broker.py); sinnvoll nur, wenn das ganze Rennen in einem Prozess läuft.
+TRANSPORTS = ("redis", "memory")
+DEFAULT_TRANSPORT = "redis"
+
+# Key-Layouts im Cluster (siehe Keyspace):
+# "flat":  Streams "stream-<segment>", Standorte "token_locations", Segmentzeiten "race_results:<token>";
+#          nur die Rundenbuchhaltung teilt sich den Hash-Tag "{race}".
+# "track": alle Keys eines Tracks tragen den Hash-Tag "{track-<id>}", die der globalen Segmente "{global}".
+#          Die Streams eines Tracks liegen damit auf demselben Knoten (bei STATE_BUCKETS = 1 auch
+#          der Zustand seiner Tokens).
+KEY_LAYOUTS = ("flat", "track")
+DEFAULT_KEY_LAYOUT = "track"
+# Der Zustand der Tokens (Standorte, Rundenbuchhaltung, Segmentzeiten) wird pro Track auf
+# STATE_BUCKETS Buckets mit eigenem Hash-Tag ("{track-<id>:b<n>}") verteilt, damit sich die
+# Schreibzugriffe über alle Knoten des Clusters verteilen. 1 = ein Hash-Tag pro Track.
+DEFAULT_STATE_BUCKETS = 8
+# Keys der Rundenbuchhaltung (Hashes bzw. Zähler pro Hash-Tag).
+LAP_KEY_NAMES = ("token_start_times", "token_rounds", "race_results", "finished_tokens")
+
+# Fortschritt eines Tokens, der in jeder Stream-Nachricht mitgeschickt wird, damit kein Segment
+# zentrale Hashes lesen muss: "round" (aktuelle Runde), "start" (Startzeit des Rennens im
+# Start-und-Ziel-Segment), "hops" (bisher durchlaufene Segmente) und "elapsed" (Summe der
+# Segmentzeiten). Rundenbuchhaltung und Standorte in Redis sind nur noch Projektionen,
+# die in der Pipeline mitgeschrieben und nie auf dem Weg eines Tokens gelesen werden.
+PROJECT_STATE = True  # Runden, Startzeiten und Standorte zusätzlich in token_rounds/token_start_times/token_locations schreiben.
+
+# Kodierung der Stream-Nachrichten und Segmentzeiten, erkennbar an der Formatversion:
+# 1: Textfelder (token, round, start, hops, elapsed, vt, lease), Segmentzeiten "<segment>:<sekunden>".
+# 2: kompakt: Nachrichten {"v": 2, "p": <Bytes>} mit festem struct-Kopf, Zeiten als ganzzahlige
+#    Nanosekunden; Segmentzeiten als (2, Segmentnummer, Nanosekunden), die Segmentnummer stammt
+#    aus der gemeinsamen Segmenttabelle des Race-Managers (Reihenfolge in tracks.json).
+# Gelesen werden immer beide Formate, geschrieben wird im eingestellten Format.
+MESSAGE_FORMATS = (1, 2)
+DEFAULT_MESSAGE_FORMAT = 1
+# round, hops, start, elapsed, vt (Nanosekunden, -1 = nicht gesetzt), Länge von token und lease
+COMPACT_MESSAGE = struct.Struct("<HIqqqBB")
+# Formatversion, Segmentnummer, Segmentzeit in Nanosekunden
+COMPACT_HOP = struct.Struct("<BHq")
+
+# Lease im verteilten Semaphor eines Segments belegen (Zeit vom Redis-Server, damit alle
+# Worker dieselbe Uhr verwenden). Abgelaufene Leases werden zuerst entfernt.
+# KEYS: leases (ZSET), capacity
+# ARGV: lease_id, ttl in ms
+# Rückgabe: 1, wenn die Lease vergeben wurde, sonst 0
+ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local capacity = tonumber(redis.call('GET', KEYS[2]) or '1')
+if redis.call('ZCARD', KEYS[1]) < capacity then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Leases eines Segments verlängern, die noch vorhanden sind (ZADD XX legt keine neuen an, eine
+# bereits abgelaufene und entfernte Lease bleibt also weg).
+# KEYS: leases (ZSET)
+# ARGV: ttl in ms, lease_id...
+# Rückgabe: Anzahl der verlängerten Leases
+RENEW_SCRIPT = """
+local t = redis.call('TIME')
+local expires = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000) + tonumber(ARGV[1])
+local renewed = 0
+for i = 2, #ARGV do
+    renewed = renewed + redis.call('ZADD', KEYS[1], 'XX', 'CH', expires, ARGV[i])
+end
+return renewed
+"""
+
+# SHA1-Hashes der bereits per SCRIPT LOAD geladenen Skripte.
+SCRIPT_SHAS = {}
+
+def track_of_token(token):
+    """Track-ID eines Tokens ('token-<track>-<n>')."""
+    return token.split("-")[1]
+
+def track_of_segment(segment_id):
+    """Track-ID eines Segments ('start-and-goal-<track>', 'segment-<track>-...'); None für globale Segmente."""
+    if segment_id.startswith("start-and-goal-"):
+        return segment_id[len("start-and-goal-"):]
+    parts = segment_id.split("-")
+    if len(parts) > 1 and parts[0] == "segment" and parts[1] != "global":
+        return parts[1]
+    return None
+
+class Keyspace:
+    """
+    Namensschema aller Redis-Keys eines Rennens (siehe KEY_LAYOUTS). Wird von Segment-Programm,
+    Worker und Race-Manager gemeinsam verwendet, damit alle dieselben Keys ansprechen.
+    Mit namespace (z.B. "race-<id>") beginnt jeder Key mit "<namespace>:"; das Präfix liegt vor
+    dem Hash-Tag und ändert die Slots daher nicht. So kann ein warmes Cluster viele Rennen
+    nacheinander tragen, deren Keys sich nicht überschneiden.
+    """
+    def __init__(self, layout=DEFAULT_KEY_LAYOUT, buckets=DEFAULT_STATE_BUCKETS, namespace=None):
+        if layout not in KEY_LAYOUTS:
+            raise ValueError(f"Unbekanntes Key-Layout: {layout}")
+        self.layout = layout
+        self.buckets = max(1, buckets)
+        self.namespace = namespace or None
+
+    def qualify(self, key):
+        """Stellt dem Key den Namensraum des Rennens voran (ohne Namensraum unverändert)."""
+        return f"{self.namespace}:{key}" if self.namespace else key
+
+    def tag(self, track, bucket=None):
+        """Hash-Tag eines Tracks (None: globale Segmente), für Token-Zustand zusätzlich pro Bucket."""
+        if self.layout == "flat":
+            name = "race"
+        else:
+            name = "global" if track is None else f"track-{track}"
+        if bucket is not None and self.buckets > 1:
+            name += f":b{bucket}"
+        return f"{{{name}}}"
+
+    def bucket(self, token):
+        """Bucket des Token-Zustands (crc32 statt hash(), damit alle Prozesse denselben Bucket wählen)."""
+        return zlib.crc32(token.encode()) % self.buckets
+
+    def stream(self, segment_id):
+        """Stream eines Segments."""
+        if self.layout == "flat":
+            return self.qualify(f"stream-{segment_id}")
+        return self.qualify(f"{self.tag(track_of_segment(segment_id))}:stream-{segment_id}")
+
+    def race_key(self, track, name, bucket=None):
+        """Key name (z.B. "finished_tokens") für die Tokens eines Tracks in einem Bucket."""
+        if self.layout == "flat" and name == "token_locations":
+            return self.qualify(name if bucket is None or self.buckets == 1 else f"{name}:b{bucket}")
+        return self.qualify(f"{self.tag(track, bucket)}:{name}")
+
+    def race_keys(self, track, name):
+        """Alle Buckets des Keys name eines Tracks (zum Zusammenführen beim Auslesen)."""
+        return [self.race_key(track, name, bucket) for bucket in range(self.buckets)]
+
+    def lap_keys(self, token):
+        """Keys der Rundenbuchhaltung eines Tokens (in der Reihenfolge von LAP_KEY_NAMES, alle im selben Slot)."""
+        bucket = self.bucket(token)
+        return tuple(self.race_key(track_of_token(token), name, bucket) for name in LAP_KEY_NAMES)
+
+    def token_location(self, token):
+        """Hash der Standorte, in dem der Standort des Tokens steht."""
+        return self.race_key(track_of_token(token), "token_locations", self.bucket(token))
+
+    def delivery(self, token, hops):
+        """Idempotenzschlüssel einer Zustellung: das Token mit hops durchlaufenen Segmenten."""
+        return self.qualify(f"{self.tag(track_of_token(token), self.bucket(token))}:delivery:{token}:{hops}")
+
+    def segment_times(self, token):
+        """Liste der Segmentzeiten eines Tokens."""
+        if self.layout == "flat":
+            return self.qualify(f"race_results:{token}")
+        return self.qualify(f"{self.tag(track_of_token(token), self.bucket(token))}:race_results:{token}")
+
+    def semaphore(self, segment_id):
+        """
+        Keys des verteilten Semaphors eines Segments (gemeinsamer Hash-Tag, damit die Skripte
+        im Cluster funktionieren): Leases (ZSET, Score = Ablaufzeit in ms), Kapazität und Weckliste.
+        """
+        if self.layout == "flat":
+            prefix = f"sem:{{{segment_id}}}"
+        else:
+            prefix = f"{self.tag(track_of_segment(segment_id))}:sem:{segment_id}"
+        prefix = self.qualify(prefix)
+        return f"{prefix}:leases", f"{prefix}:capacity", f"{prefix}:wake"
+
+    def routing_metrics(self):
+        """Hash mit den Kennzahlen der least-loaded-Lastsicht (siehe StreamLoadView)."""
+        return self.qualify(ROUTING_METRICS_KEY)
+
+    def finish_stream(self):
+        """Stream der fertigen Tokens (siehe FINISH_STREAM)."""
+        return self.qualify(FINISH_STREAM)
+
+    def location_stream(self, track):
+        """Stream der Standortänderungen der Tokens eines Tracks (siehe LOCATION_STREAM)."""
+        if self.layout == "flat":
+            return self.qualify(LOCATION_STREAM)
+        return self.qualify(f"{self.tag(track)}:{LOCATION_STREAM}")
+
+def ensure_consumer_group(client, stream_name, group_name):
+    """
+    Legt die Consumer Group für den Stream an (inklusive des Streams selbst).
+    Die Gruppe startet bei ID 0, damit auch Tokens verarbeitet werden, die vor
+    dem Start des Segments in den Stream geschrieben wurden.
+    """
+    try:
+        client.xgroup_create(stream_name, group_name, id="0", mkstream=True)
+        print(f"Consumer Group {group_name} für {stream_name} angelegt.")
+    except ResponseError as e:
+        # BUSYGROUP: Die Gruppe existiert bereits (z.B. nach einem Neustart).
+        if "BUSYGROUP" not in str(e):
+            raise
+
+def init_semaphore(client, keyspace, segment_id, capacity):
+    """Setzt den Semaphor eines Segments zurück: keine Leases, capacity freie Plätze."""
+    leases_key, capacity_key, wake_key = keyspace.semaphore(segment_id)
+    pipe = client.pipeline()
+    pipe.delete(leases_key)
+    pipe.delete(wake_key)
+    pipe.set(capacity_key, capacity)
+    pipe.execute()
+
+def acquire_lease(client, keyspace, segment_id, lease_id, ttl, cancelled=None, on_wait=None):
+    """
+    Belegt einen Platz im Semaphor des Segments für ttl Sekunden (verlängerbar, siehe renew_leases).
+    Ist das Segment voll, wird per BLPOP auf der Weckliste gewartet: Der Aufruf kehrt
+    sofort zurück, wenn ein Platz freigegeben wird, spätestens aber nach ttl Sekunden,
+    wenn eine Lease abgelaufen sein kann (z.B. weil ein Worker abgestürzt ist).
+    Mit cancelled (threading.Event) oder on_wait wird in Runden von LEASE_WAIT_ROUND Sekunden
+    gewartet: on_wait wird nach jeder Runde aufgerufen (z.B. um die gehaltenen Leases zu
+    verlängern), nach dem Setzen von cancelled wird abgebrochen, ohne den Semaphor noch einmal
+    anzufassen. Gibt zurück, ob die Lease belegt wurde.
+    """
+    leases_key, capacity_key, wake_key = keyspace.semaphore(segment_id)
+    ttl_ms = int(ttl * 1000)
+    timeout = max(1, int(ttl)) if cancelled is None and on_wait is None else LEASE_WAIT_ROUND
+    while not eval_script(client, ACQUIRE_SCRIPT, (leases_key, capacity_key), (lease_id, ttl_ms)):
+        client.blpop(wake_key, timeout)
+        if cancelled is not None and cancelled.is_set():
+            return False
+        if on_wait is not None:
+            on_wait()
+    return True
+
+def renew_leases(client, keyspace, segment_id, lease_ids, ttl):
+    """Verlängert die übergebenen Leases im Semaphor des Segments um ttl Sekunden ab jetzt."""
+    if not lease_ids:
+        return 0
+    leases_key = keyspace.semaphore(segment_id)[0]
+    return eval_script(client, RENEW_SCRIPT, (leases_key,), (int(ttl * 1000), *lease_ids))
+
+def queue_release_lease(pipe, keyspace, segment_id, lease_id, capacity):
+    """Hängt das Freigeben einer Lease und das Wecken eines wartenden Tokens an die Pipeline an."""
+    leases_key, _, wake_key = keyspace.semaphore(segment_id)
+    pipe.zrem(leases_key, lease_id)
+    pipe.rpush(wake_key, "1")
+    # Die Weckliste nie länger als die Kapazität werden lassen (überzählige Einträge sind wirkungslos).
+    pipe.ltrim(wake_key, 0, capacity - 1)
+
+def load_script(client, script):
+    """Lädt ein Lua-Skript per SCRIPT LOAD auf alle Master und merkt sich den SHA1-Hash."""
+    SCRIPT_SHAS[script] = client.script_load(script)
+    return SCRIPT_SHAS[script]
+
+def eval_script(client, script, keys, args):
+    """Führt ein Lua-Skript per EVALSHA aus und lädt es bei Bedarf (nach)."""
+    sha = SCRIPT_SHAS.get(script) or load_script(client, script)
+    try:
+        return client.evalsha(sha, len(keys), *keys, *args)
+    except NoScriptError:
+        # Skript-Cache wurde geleert (z.B. Neustart eines Knotens): neu laden und wiederholen.
+        return client.evalsha(load_script(client, script), len(keys), *keys, *args)
+
+def to_ns(seconds):
+    """Sekunden als ganzzahlige Nanosekunden (-1 für None)."""
+    return -1 if seconds is None else int(round(float(seconds) * 1e9))
+
+def from_ns(ns):
+    """Gegenstück zu to_ns."""
+    return None if ns < 0 else ns / 1e9
+
+def to_wire(raw):
+    """
+    Bytes als str für den Client mit decode_responses=True. Dank encoding_errors="surrogateescape"
+    (siehe create_client) kommen beim Schreiben wieder genau dieselben Bytes in Redis an.
+    """
+    return raw.decode("utf-8", "surrogateescape")
+
+def from_wire(text):
+    """Gegenstück zu to_wire."""
+    return text.encode("utf-8", "surrogateescape")
+
+def encode_message(message, message_format=DEFAULT_MESSAGE_FORMAT):
+    """Kodiert die Felder einer Stream-Nachricht im angegebenen Format (siehe MESSAGE_FORMATS)."""
+    if message_format == 1:
+        return message
+    token = message["token"].encode()
+    lease = message.get("lease", "").encode()
+    header = COMPACT_MESSAGE.pack(int(message.get("round", 0)), int(message.get("hops", 0)),
+                                  to_ns(message.get("start")), to_ns(message.get("elapsed", 0)),
+                                  to_ns(message.get("vt")), len(token), len(lease))
+    return {"v": 2, "p": to_wire(header + token + lease)}
+
+def decode_message(data):
+    """Liest die Felder einer Stream-Nachricht in beiden Formaten (Format 1 unverändert)."""
+    if str(data.get("v", 1)) != "2":
+        return data
+    raw = from_wire(data["p"])
+    current, hops, start, elapsed, vt, token_len, lease_len = COMPACT_MESSAGE.unpack_from(raw)
+    offset = COMPACT_MESSAGE.size
+    message = {"token": raw[offset:offset + token_len].decode(), "round": current, "hops": hops,
+               "elapsed": from_ns(elapsed)}
+    if start >= 0:
+        message["start"] = from_ns(start)
+    if vt >= 0:
+        message["vt"] = from_ns(vt)
+    if lease_len:
+        message["lease"] = raw[offset + token_len:offset + token_len + lease_len].decode()
+    return message
+
+def encode_hop(segment_id, segment_index, seconds, message_format=DEFAULT_MESSAGE_FORMAT):
+    """Eintrag für die Liste der Segmentzeiten eines Tokens (kompakt nur mit bekannter Segmentnummer)."""
+    if message_format == 1 or segment_index is None:
+        return f"{segment_id}:{seconds}"
+    return to_wire(COMPACT_HOP.pack(2, segment_index, to_ns(seconds)))
+
+def decode_hop(record, segment_table):
+    """Liest einen Eintrag der Segmentzeiten in beiden Formaten; gibt (Segment, Sekunden) zurück."""
+    raw = from_wire(record)
+    if len(raw) == COMPACT_HOP.size and raw[0] == 2:
+        _, segment_index, ns = COMPACT_HOP.unpack(raw)
+        return segment_table[segment_index], from_ns(ns)
+    segment, seconds = record.rsplit(":", 1)
+    return segment, float(seconds)
+
+def token_progress(data):
+    """Fortschritt eines Tokens aus den Nachrichtenfeldern (Standardwerte für neu gestartete Tokens)."""
+    start = data.get("start")
+    return (int(data.get("round", 0)), float(start) if start is not None else None,
+            int(data.get("hops", 0)), float(data.get("elapsed", 0)))
+
+def create_client(redis_host, redis_port, transport=DEFAULT_TRANSPORT):
+    """
+    Erstellt den Client des gewählten Transports (siehe TRANSPORTS): einen cluster-fähigen
+    Redis-Client (Binärdaten verlustfrei, siehe to_wire) oder einen In-Memory-Broker.
+    """
+    if transport == "memory":
+        from memory_broker import MemoryBroker
+        return MemoryBroker()
+    from rediscluster import RedisCluster
     startup_nodes = [{"host": redis_host, "port": redis_port}]
-    client = RedisCluster(startup_nodes=startup_nodes, decode_responses=True)
-    
-    stream_name = f"stream-{segment_id}"
-    rounds_hash = "token_rounds"
-    start_times_hash = "token_start_times"
+    return RedisCluster(startup_nodes=startup_nodes, decode_responses=True, encoding_errors="surrogateescape")
+
+def random_delay():
+    """Simulierte Bearbeitungszeit eines Tokens im Segment (in Sekunden)."""
+    return random.uniform(*DELAY_RANGE)
+
+# Ein Token, dessen Bearbeitungszeit abgelaufen ist; target ist das gewählte nächste Segment.
+Departure = namedtuple("Departure", "segment entry_id token data seg_duration virtual_time target",
+                       defaults=(None,))
+
+class StreamLoadView:
+    """
+    Lokal zwischengespeicherte Rückstände (siehe stream_backlog) aller Verzweigungsziele von
+    least-loaded-Segmenten. Statt pro Token wird die Sicht periodisch in einer Pipeline
+    aufgefrischt; Aktualisierungsintervall und Alter der Sicht landen in ROUTING_METRICS_KEY
+    (im Namensraum des Rennens, siehe Keyspace.routing_metrics).
+    """
+    def __init__(self, client, segments, consumer_name, refresh_interval=LOAD_REFRESH_INTERVAL,
+                 max_staleness=LOAD_MAX_STALENESS, keyspace=None):
+        self.client = client
+        self.keyspace = keyspace or Keyspace()
+        self.consumer_name = consumer_name
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.targets = sorted({nxt for segment in segments if segment.routing == "least-loaded"
+                               and len(segment.next_segments) > 1 for nxt in segment.next_segments})
+        self.lengths = {}
+        self.refreshed_at = None
+        self.refreshes = 0
+        self.stale_decisions = 0
+
+    def due(self, now):
+        """Prüft, ob die Sicht neu gelesen werden muss."""
+        return bool(self.targets) and (self.refreshed_at is None or now - self.refreshed_at >= self.refresh_interval)
+
+    def refresh(self):
+        """Liest die Rückstände aller Ziel-Streams in einer Pipeline und schreibt die Kennzahlen."""
+        try:
+            pipe = self.client.pipeline()
+            for nxt in self.targets:
+                pipe.xinfo_groups(self.keyspace.stream(nxt))
+                pipe.xlen(self.keyspace.stream(nxt))
+            # Noch nicht angelegte Streams (Segment nicht gestartet) zählen als leer.
+            replies = pipe.execute(raise_on_error=False)
+            lengths = {nxt: stream_backlog(groups, f"group-{nxt}", length)
+                       for nxt, groups, length in zip(self.targets, replies[::2], replies[1::2])}
+            now = time.time()
+            age = 0.0 if self.refreshed_at is None else now - self.refreshed_at
+            self.lengths, self.refreshed_at = lengths, now
+            self.refreshes += 1
+            self.queue_metrics(self.client.pipeline(), age).execute()
+        except Exception as e:
+            # Die alte Sicht bleibt gültig, bis sie älter als max_staleness ist.
+            print(f"[{self.consumer_name}] Fehler beim Aktualisieren der Rückstände: {e}")
+
+    def refresh_if_due(self):
+        if self.due(time.time()):
+            self.refresh()
+
+    def current(self, now):
+        """Aktuelle Sicht oder None, wenn sie zu alt ist."""
+        if self.refreshed_at is None or now - self.refreshed_at > self.max_staleness:
+            return None
+        return self.lengths
+
+    def queue_metrics(self, pipe, age):
+        """Hängt die Kennzahlen der Sicht (Alter der ersetzten Sicht, Zähler, Einstellungen) an die Pipeline an."""
+        metrics = {"refresh_interval": self.refresh_interval, "max_staleness": self.max_staleness,
+                   "refreshes": self.refreshes, "staleness": round(age, 3),
+                   "stale_decisions": self.stale_decisions, "targets": len(self.targets)}
+        for name, value in metrics.items():
+            pipe.hset(self.keyspace.routing_metrics(), f"{self.consumer_name}:{name}", value)
+        return pipe
+
+def deduplicate(client, segments, batches, ttl=DELIVERY_TTL):
+    """
+    Filtert doppelte Zustellungen aus den gelesenen Batches (eine Pipeline für alle Segmente):
+    Pro Token und Fortschritt gewinnt die erste Stream-Nachricht; erneute Zustellungen derselben
+    Nachricht (z.B. nach XCLAIM) gelten weiterhin als gültig. Duplikate werden bestätigt,
+    eine mitgeschickte Lease freigegeben.
+    """
+    pipe = client.pipeline()
+    for segment, batch in zip(segments, batches):
+        for entry_id, token, data in batch:
+            segment.queue_delivery_claim(pipe, entry_id, token, data, ttl)
+    if len(pipe) == 0:
+        return batches
+    owners = iter(pipe.execute()[1::2])
+    drop = client.pipeline()
+    kept = []
+    for segment, batch in zip(segments, batches):
+        kept.append([])
+        for entry_id, token, data in batch:
+            if next(owners) == segment.delivery_id(entry_id):
+                kept[-1].append((entry_id, token, data))
+            else:
+                print(f"[{segment.segment_id}] Token {token} wurde bereits zugestellt, Duplikat {entry_id} verworfen.")
+                segment.release(drop, data)
+                segment.ack(drop, entry_id)
+    flush(drop)
+    return kept
+
+def sweep(client, segments, scheduler, min_idle):
+    """
+    Sucht in den Streams aller Segmente mit freier Kapazität nach liegengebliebenen Einträgen
+    (XPENDING in einer Pipeline) und übernimmt sie. Gibt pro Segment einen Batch zurück.
+    """
+    pipe = client.pipeline()
+    for segment in segments:
+        # Die eigenen Tokens in Bearbeitung stehen ebenfalls in der Liste, daher capacity zusätzlich.
+        segment.queue_pending(pipe, scheduler.free(segment) + segment.capacity)
+    return [segment.reclaim(pending, min_idle, scheduler.free(segment))
+            for segment, pending in zip(segments, pipe.execute())]
+
+def next_stream_id(entry_id):
+    """Kleinste Stream-ID nach entry_id ("<ms>-<seq>")."""
+    ms, seq = entry_id.split("-")
+    return f"{ms}-{int(seq) + 1}"
+
+def stream_backlog(groups, group_name, length):
+    """
+    Rückstand eines Streams für least-loaded: unbestätigte plus ungelesene Einträge der Consumer
+    Group (Feld "lag", ab Redis 7). Ohne diese Angabe dient die Stream-Länge als Näherung.
+    """
+    if not isinstance(groups, Exception):
+        for group in groups:
+            if group["name"] == group_name and group.get("lag") is not None:
+                return group["pending"] + group["lag"]
+    return 0 if isinstance(length, Exception) else length
+
+def trim_streams(client, segments):
+    """Kürzt die Streams aller Segmente bis zum ältesten unbestätigten Eintrag (je zwei Pipelines)."""
+    pipe = client.pipeline()
+    for segment in segments:
+        pipe.xinfo_groups(segment.stream_name)
+        pipe.xpending(segment.stream_name, segment.group_name)
+    replies = pipe.execute()
+    pipe = client.pipeline()
+    for segment, groups, pending in zip(segments, replies[::2], replies[1::2]):
+        segment.queue_trim(pipe, groups, pending)
+    flush(pipe)
+
+def route_departures(departures, load_view=None):
+    """
+    Wählt für jedes Token genau ein nächstes Segment (siehe ROUTING_POLICIES). least-loaded
+    entscheidet anhand der zwischengespeicherten Sicht load_view, ohne den Cluster abzufragen.
+    """
+    lengths = load_view.current(time.time()) if load_view is not None else None
+    routed = []
+    for d in departures:
+        candidates = d.segment.route_candidates(d.token)
+        if lengths is None and load_view is not None and d.segment.routing == "least-loaded" and len(candidates) > 1:
+            load_view.stale_decisions += 1
+        routed.append(d._replace(target=d.segment.route(candidates, lengths)))
+    return routed
+
+def default_capacity(segment_type):
+    """Standard-Kapazität eines Segmenttyps: Bottlenecks bearbeiten immer nur ein Token gleichzeitig."""
+    return 1 if segment_type in SERIAL_SEGMENT_TYPES else DEFAULT_CAPACITY
+
+class Segment:
+    """
+    Redis-Zugriffe eines Segments, unabhängig davon, wie es betrieben wird
+    (eigener Prozess über process_segment oder zusammen mit anderen Segmenten
+    im asyncio-Worker aus segment_worker.py).
+    Methoden, die nur eine Pipeline befüllen, führen selbst keinen Netzwerkzugriff aus.
+    """
+
+    def __init__(self, client, segment_id, next_segments, max_rounds=3, consumer_name=None,
+                 segment_type="normal", capacity=None, gated_next=(), lease_ttl=LEASE_TTL,
+                 routing=DEFAULT_ROUTING, weights=None, keyspace=None, project_state=PROJECT_STATE,
+                 message_format=DEFAULT_MESSAGE_FORMAT, segment_index=None, stream_maxlen=STREAM_MAXLEN):
+        self.client = client
+        self.keyspace = keyspace or Keyspace()
+        self.project_state = project_state
+        self.message_format = message_format
+        # Nummer des Segments in der Segmenttabelle des Race-Managers (für kompakte Segmentzeiten).
+        self.segment_index = segment_index
+        # Obergrenze (MAXLEN ~) für die Streams der nächsten Segmente beim XADD, 0 = keine.
+        self.stream_maxlen = stream_maxlen
+        self.segment_id = segment_id
+        self.next_segments = next_segments
+        self.routing = routing
+        # Gewichte für "weighted", in der Reihenfolge von next_segments (Standard: alle gleich).
+        self.weights = dict(zip(next_segments, weights or [1] * len(next_segments)))
+        # Nächste Segmente mit Zulassungskontrolle (siehe GATED_SEGMENT_TYPES).
+        self.gated_next = set(gated_next)
+        self.lease_ttl = lease_ttl
+        self.max_rounds = max_rounds
+        self.segment_type = segment_type
+        self.capacity = capacity or default_capacity(segment_type)
+        self.stream_name = self.keyspace.stream(segment_id)
+        self.group_name = f"group-{segment_id}"
+        self.consumer_name = consumer_name or socket.gethostname()
+        self.is_start_goal = segment_id.startswith("start-and-goal")
+        # Zuerst die noch unbestätigten Einträge dieses Consumers lesen (ab ID "0"),
+        # danach nur noch neue Einträge (ID ">").
+        self.read_id = "0"
+        # Leases der Tokens, die gerade in diesem Segment sind (werden per renew_leases verlängert).
+        self.held_leases = set()
+
+    def setup(self):
+        """Legt die Consumer Group an und lädt die benötigten Lua-Skripte."""
+        ensure_consumer_group(self.client, self.stream_name, self.group_name)
+        if self.gated_next:
+            load_script(self.client, ACQUIRE_SCRIPT)
+
+    def queue_read(self, pipe, count=10):
+        """Hängt ein nicht-blockierendes XREADGROUP für diesen Stream an eine Pipeline an."""
+        pipe.xreadgroup(self.group_name, self.consumer_name, {self.stream_name: self.read_id}, count=count)
+
+    def read(self, count=10, block=None):
+        """Liest bis zu count Einträge über die Consumer Group (siehe parse_read)."""
+        if self.read_id != ">":
+            block = None
+        messages = self.client.xreadgroup(self.group_name, self.consumer_name, {self.stream_name: self.read_id},
+                                          count=count, block=block)
+        return self.parse_read(messages)
+
+    def parse_read(self, messages):
+        """
+        Wandelt eine XREADGROUP-Antwort in eine Liste von (entry_id, token, Nachrichtenfelder) um.
+        Bereits gelöschte, aber noch unbestätigte Einträge werden direkt bestätigt.
+        """
+        entries = [entry for _, stream_entries in messages or [] for entry in stream_entries]
+        if self.read_id != ">":
+            # Unbestätigte Einträge fortlaufend lesen; sind keine mehr übrig, auf neue umschalten.
+            self.read_id = entries[-1][0] if entries else ">"
+        return self.parse_entries(entries)
+
+    def parse_entries(self, entries):
+        """Dekodiert (entry_id, Felder)-Paare; bereits gelöschte Einträge werden direkt bestätigt."""
+        batch = []
+        deleted = []
+        for entry_id, entry_data in entries:
+            if entry_id is None:
+                continue
+            if not entry_data:
+                deleted.append(entry_id)
+                continue
+            entry_data = decode_message(entry_data)
+            batch.append((entry_id, entry_data.get("token"), entry_data))
+        if deleted:
+            self.client.xack(self.stream_name, self.group_name, *deleted)
+        return batch
+
+    def queue_pending(self, pipe, count):
+        """Hängt das Abfragen der unbestätigten Einträge (XPENDING) an die Pipeline an."""
+        pipe.xpending_range(self.stream_name, self.group_name, "-", "+", count)
+
+    def reclaim(self, pending, min_idle, limit):
+        """
+        Übernimmt per XCLAIM höchstens limit Einträge anderer Consumer, die seit mindestens min_idle
+        Sekunden unbestätigt sind (z.B. weil deren Worker abgestürzt ist), und gibt sie als Batch zurück.
+        """
+        min_idle_ms = int(min_idle * 1000)
+        ids = [p["message_id"] for p in pending
+               if p["consumer"] != self.consumer_name and p["time_since_delivered"] >= min_idle_ms][:limit]
+        if not ids:
+            return []
+        batch = self.parse_entries(self.client.xclaim(self.stream_name, self.group_name, self.consumer_name,
+                                                      min_idle_ms, ids))
+        for _, token, _ in batch:
+            print(f"[{self.segment_id}] Token {token} von einem ausgefallenen Consumer übernommen.")
+        return batch
+
+    def delivery_id(self, entry_id):
+        """Wert des Idempotenzschlüssels für einen Eintrag dieses Streams."""
+        return f"{self.stream_name}:{entry_id}"
+
+    def queue_delivery_claim(self, pipe, entry_id, token, data, ttl):
+        """Belegt den Idempotenzschlüssel der Zustellung (falls frei) und liest seinen Besitzer."""
+        key = self.keyspace.delivery(token, token_progress(data)[2])
+        pipe.set(key, self.delivery_id(entry_id), nx=True, ex=ttl)
+        pipe.get(key)
+
+    def queue_received(self, pipe, batch):
+        """
+        Hängt für alle Tokens des Batches ein Ereignis im Standort-Stream des Tracks an die
+        Pipeline an; den Standort-Hash gibt es nur als Projektion (project_state).
+        """
+        for entry_id, token, data in batch:
+            print(f"[{self.segment_id}] Token {token} empfangen (ID: {entry_id}).")
+            if data.get("lease"):
+                self.held_leases.add(data["lease"])
+            if self.project_state:
+                pipe.hset(self.keyspace.token_location(token), token, self.segment_id)
+            pipe.xadd(self.keyspace.location_stream(track_of_token(token)), {"token": token, "segment": self.segment_id},
+                      maxlen=LOCATION_STREAM_MAXLEN, approximate=True)
+
+    def enter(self, pipe, entry_id, token, data, now):
+        """
+        Rundenwechsel beim Betreten des Segments zum Zeitpunkt now (nur im Start-und-Ziel-Segment).
+        Runde und Startzeit stehen in der Nachricht und werden dort fortgeschrieben; Redis wird
+        nur beschrieben (Projektionen, Ergebnis, finished_tokens und Finish-Stream), nie gelesen.
+        Gibt False zurück, wenn das Token das Rennen beendet hat; die Bestätigung der
+        Nachricht wird dann an die Pipeline angehängt.
+        """
+        print(f"[{self.segment_id}] Token {token} Standort gesetzt auf {self.segment_id}.")
+        if not self.is_start_goal:
+            return True
+        current, start, hops, elapsed = token_progress(data)
+        current += 1
+        if start is None:
+            start = now
+        data["round"], data["start"] = current, start
+        start_times_key, rounds_key, results_key, finished_key = self.keyspace.lap_keys(token)
+        if self.project_state:
+            pipe.hset(start_times_key, token, start if self.message_format == 1 else to_ns(start))
+            pipe.hset(rounds_key, token, current)
+        print(f"[{self.segment_id}] Token {token} Runde: {current}")
+        if current <= self.max_rounds:
+            return True
+        runtime = now - start
+        pipe.hset(results_key, token, runtime)
+        pipe.incr(finished_key)
+        # Ereignis für den Race-Manager, der blockierend auf das Ende des Rennens wartet.
+        pipe.xadd(self.keyspace.finish_stream(), {"token": token, "runtime": runtime})
+        print(f"[{self.segment_id}] Token {token} hat das Rennen beendet. Gesamtzeit: {runtime:.2f} Sekunden "
+              f"({hops} Segmente, Summe der Segmentzeiten: {elapsed:.2f} Sekunden)")
+        # Bestätige und lösche die Nachricht, damit sie nicht erneut verarbeitet wird.
+        self.release(pipe, data)
+        self.ack(pipe, entry_id)
+        return False
+
+    def route_candidates(self, token):
+        """
+        Nächste Segmente, die für das Token in Frage kommen. Globale Segmente verzweigen in
+        die Rückführungen aller Tracks; ein Token kehrt aber immer auf seinen eigenen Track zurück.
+        """
+        track = track_of_token(token)
+        own = [nxt for nxt in self.next_segments if track_of_segment(nxt) in (None, track)]
+        return own or self.next_segments
+
+    def route(self, candidates, lengths=None):
+        """Wählt eines der Kandidatensegmente gemäß der Routing-Strategie des Segments."""
+        if len(candidates) == 1 or self.routing == "first":
+            return candidates[0]
+        if self.routing == "weighted":
+            return random.choices(candidates, weights=[self.weights.get(nxt, 1) for nxt in candidates])[0]
+        if self.routing == "least-loaded" and lengths:
+            # Bei gleichem Rückstand zufällig, sonst bekäme das erste Segment alle Gleichstände.
+            least = min(lengths.get(nxt, 0) for nxt in candidates)
+            return random.choice([nxt for nxt in candidates if lengths.get(nxt, 0) == least])
+        return random.choice(candidates)
+
+    def acquire_lease(self, target, token, cancelled=None, on_wait=None):
+        """
+        Belegt blockierend eine Lease im Zielsegment und gibt die Lease-ID zurück
+        (None, wenn das Warten über cancelled abgebrochen wurde, siehe acquire_lease).
+        """
+        lease_id = f"{token}:{uuid.uuid4().hex}"
+        if not acquire_lease(self.client, self.keyspace, target, lease_id, self.lease_ttl, cancelled, on_wait):
+            return None
+        return lease_id
+
+    def renew_leases(self):
+        """Verlängert die Leases aller Tokens, die gerade in diesem Segment sind."""
+        renew_leases(self.client, self.keyspace, self.segment_id, list(self.held_leases.copy()), self.lease_ttl)
+
+    def release(self, pipe, data):
+        """Gibt die Lease frei, mit der das Token in dieses Segment zugelassen wurde."""
+        if data.get("lease"):
+            self.held_leases.discard(data["lease"])
+            queue_release_lease(pipe, self.keyspace, self.segment_id, data["lease"], self.capacity)
+
+    def leave(self, pipe, departure, lease=None):
+        """
+        Hängt Segmentzeit, Weiterleitung an das gewählte nächste Segment (departure.target) und
+        Bestätigung eines Tokens an die Pipeline an. Die Nachricht trägt den fortgeschriebenen
+        Fortschritt des Tokens (siehe token_progress), im virtuellen Modus zusätzlich die virtuelle
+        Ankunftszeit und bei zulassungskontrollierten Zielsegmenten die dort belegte Lease.
+        """
+        token = departure.token
+        # Pro Segment wird die verstrichene Zeit in einer Liste protokolliert.
+        pipe.rpush(self.keyspace.segment_times(token),
+                   encode_hop(self.segment_id, self.segment_index, departure.seg_duration, self.message_format))
+        print(f"[{self.segment_id}] Token {token} verbrachte {departure.seg_duration:.2f} Sekunden in diesem Segment.")
+        
+        # Leite das Token an genau ein folgendes Segment weiter.
+        current, start, hops, elapsed = token_progress(departure.data)
+        message = {"token": token, "round": current, "hops": hops + 1, "elapsed": elapsed + departure.seg_duration}
+        if start is not None:
+            message["start"] = start
+        if departure.virtual_time is not None:
+            message["vt"] = departure.virtual_time
+        if lease is not None:
+            message["lease"] = lease
+        pipe.xadd(self.keyspace.stream(departure.target), encode_message(message, self.message_format),
+                  maxlen=self.stream_maxlen or None, approximate=True)
+        print(f"[{self.segment_id}] Token {token} wird weitergeleitet an {departure.target}.")
+        # Das Token hat das Segment verlassen: Platz für das nächste wartende Token freigeben.
+        self.release(pipe, departure.data)
+        self.ack(pipe, departure.entry_id)
+
+    def ack(self, pipe, entry_id):
+        """Bestätigt die Nachricht in der Consumer Group (entfernt wird sie später per queue_trim)."""
+        pipe.xack(self.stream_name, self.group_name, entry_id)
+
+    def queue_trim(self, pipe, groups, pending):
+        """
+        Hängt XTRIM MINID ~ an die Pipeline an: Alles vor dem ältesten unbestätigten Eintrag ist
+        bearbeitet; ohne unbestätigte Einträge alles bis einschließlich des zuletzt gelesenen.
+        """
+        group = next((g for g in groups if g["name"] == self.group_name), None)
+        if group is None:
+            return
+        minid = pending["min"] if pending["pending"] else next_stream_id(group["last-delivered-id"])
+        # redis-py 3.5 kennt XTRIM nur mit MAXLEN, daher direkt als Befehl (MINID ab Redis 6.2).
+        pipe.execute_command("XTRIM", self.stream_name, "MINID", "~", minid)
+
+class TokenScheduler:
+    """
+    Timer-Heap für Tokens, die gerade in einem Segment bearbeitet werden.
+    Jedes Segment nimmt bis zu segment.capacity Tokens gleichzeitig auf; jedes Token
+    wird weitergeleitet, sobald seine eigene Bearbeitungszeit abgelaufen ist. Seinen Platz
+    gibt es erst frei, wenn es das Segment verlassen hat (left), also auch nicht, solange es
+    noch auf die Lease des nächsten Segments wartet (wie im Simulator).
+    Ein Scheduler kann die Tokens eines einzelnen Segments (process_segment) oder
+    vieler Segmente (segment_worker.py) verwalten.
+
+    Im virtuellen Modus (virtual=True) wird nicht gewartet: Jede Nachricht trägt ihre
+    virtuelle Ankunftszeit ("vt"), das Token belegt den frühesten freien der capacity
+    Plätze des Segments in virtueller Zeit und wird sofort mit der virtuellen
+    Ankunftszeit im nächsten Segment weitergeleitet.
+    Das ist nur eine Näherung: Die Plätze werden in der Reihenfolge vergeben, in der die
+    Nachrichten real eintreffen, nicht nach virtueller Zeit, und vor einem Segment mit
+    Zulassungskontrolle hält ein Token seinen Platz im vorherigen Segment nicht fest. Engpässe
+    wirken daher anders als im Simulator (race_simulator.py) und in Rennen mit realer Uhr.
+    """
+
+    def __init__(self, virtual=False):
+        self.virtual = virtual
+        self.heap = []
+        self.in_flight = {}
+        self.seq = itertools.count()
+        # Virtueller Modus: pro Segment ein Min-Heap der Zeitpunkte, zu denen die Plätze frei werden.
+        self.slots_free_at = {}
+
+    def free(self, segment):
+        """Anzahl der Tokens, die das Segment zusätzlich aufnehmen kann."""
+        return segment.capacity - self.in_flight.get(segment.segment_id, 0)
+
+    def admit(self, segment, pipe, batch, now):
+        """Nimmt die Tokens eines gelesenen Batches auf und plant ihr Weiterleiten ein."""
+        for entry_id, token, data in batch:
+            arrival = float(data.get("vt", 0)) if self.virtual else now
+            if not segment.enter(pipe, entry_id, token, data, arrival):
+                continue
+            # Simuliere die Bearbeitungszeit im Segment (zufälliges Delay).
+            delay = random_delay()
+            if self.virtual:
+                slots = self.slots_free_at.setdefault(segment.segment_id, [0.0] * segment.capacity)
+                start = max(arrival, slots[0])
+                heapq.heapreplace(slots, start + delay)
+                # Sofort weiterleiten, die Reihenfolge im Heap folgt der virtuellen Zeit.
+                item = (now, start + delay, next(self.seq), segment, entry_id, token, data, start)
+            else:
+                print(f"[{segment.segment_id}] Bearbeitung für {delay:.2f} Sekunden...")
+                item = (now + delay, now + delay, next(self.seq), segment, entry_id, token, data, now)
+            heapq.heappush(self.heap, item)
+            self.in_flight[segment.segment_id] = self.in_flight.get(segment.segment_id, 0) + 1
+
+    def next_deadline(self):
+        """Zeitpunkt, zu dem das nächste Token fertig ist (None, wenn keines in Bearbeitung ist)."""
+        return self.heap[0][0] if self.heap else None
+
+    def release_expired(self, now):
+        """
+        Entnimmt alle Tokens mit abgelaufener Bearbeitungszeit und gibt sie als Liste von
+        Departure-Einträgen (noch ohne gewähltes Zielsegment) zurück. Ihre Plätze bleiben belegt,
+        bis sie über left freigegeben werden.
+        """
+        departures = []
+        while self.heap and self.heap[0][0] <= now:
+            _, done_at, _, segment, entry_id, token, data, seg_start = heapq.heappop(self.heap)
+            if self.virtual:
+                departures.append(Departure(segment, entry_id, token, data, done_at - seg_start, done_at))
+            else:
+                departures.append(Departure(segment, entry_id, token, data, now - seg_start, None))
+        return departures
+
+    def left(self, departures):
+        """Gibt die Plätze der Tokens frei, die ihr Segment verlassen haben (nach Segment.leave)."""
+        for departure in departures:
+            self.in_flight[departure.segment.segment_id] -= 1
+
+    def needs_admission(self, departure):
+        """
+        Prüft, ob für das Weiterleiten erst eine Lease geholt werden muss. Im virtuellen Modus
+        wird die Kapazität nur über die virtuellen Plätze abgebildet (ohne Warten vor dem Segment).
+        """
+        return not self.virtual and departure.target in departure.segment.gated_next
+
+def flush(pipe):
+    """Führt die Pipeline aus, sofern Befehle darin stehen."""
+    if len(pipe) > 0:
+        pipe.execute()
+
+def process_segment(segment_id, next_segments, redis_host="redis", redis_port=6379, max_rounds=3,
+                    consumer_name=None, batch_size=10, segment_type="normal", capacity=None, clock="wall",
+                    gated_next=(), lease_ttl=LEASE_TTL, routing=DEFAULT_ROUTING, weights=None,
+                    load_refresh_interval=LOAD_REFRESH_INTERVAL, load_max_staleness=LOAD_MAX_STALENESS,
+                    key_layout=DEFAULT_KEY_LAYOUT, state_buckets=DEFAULT_STATE_BUCKETS, project_state=PROJECT_STATE,
+                    message_format=DEFAULT_MESSAGE_FORMAT, segment_index=None, recovery_idle=RECOVERY_IDLE,
+                    recovery_interval=RECOVERY_INTERVAL, trim_interval=TRIM_INTERVAL, stream_maxlen=STREAM_MAXLEN):
+    client = create_client(redis_host, redis_port)
+    keyspace = Keyspace(key_layout, state_buckets)
+    segment = Segment(client, segment_id, next_segments, max_rounds, consumer_name, segment_type, capacity,
+                      gated_next, lease_ttl, routing, weights, keyspace, project_state, message_format,
+                      segment_index, stream_maxlen)
+    segment.setup()
+    load_view = StreamLoadView(client, [segment], segment.consumer_name, load_refresh_interval, load_max_staleness,
+                               keyspace)
+    scheduler = TokenScheduler(virtual=(clock == "virtual"))
+    print(f"Segment {segment_id} gestartet (Redis Cluster: {redis_host}:{redis_port}, "
+          f"Consumer: {segment.consumer_name}, Kapazität: {segment.capacity}, Uhr: {clock})...")
     
-    print(f"Segment {segment_id} gestartet (Redis Cluster: {redis_host}:{redis_port})...")
+    def receive(pipe, batch):
+        # Doppelte Zustellungen verwerfen (nur mit Wiederherstellung), dann Standorte setzen und
+        # Rundenbuchhaltung; Schreibzugriffe landen in der Pipeline.
+        if recovery_idle > 0:
+            batch = deduplicate(client, [segment], [batch])[0]
+        if batch:
+            segment.queue_received(pipe, batch)
+            scheduler.admit(segment, pipe, batch, time.time())
     
+    next_sweep = time.time() if recovery_idle > 0 else None
+    next_trim = time.time() + trim_interval if trim_interval > 0 else None
+    next_renew = time.time() + lease_ttl / LEASE_RENEW_DIVISOR
     while True:
-        # Lese neue Nachrichten aus dem eigenen Stream.
-        messages = client.xread({stream_name: "$"}, block=0)
-        for _, entries in messages:
-            for entry_id, entry_data in entries:
-                token = entry_data.get("token")
-                print(f"[{segment_id}] Token {token} empfangen (ID: {entry_id}).")
-                
-                # Setze den aktuellen Standort im Hash "token_locations".
-                client.hset("token_locations", token, segment_id)
-                print(f"[{segment_id}] Token {token} Standort gesetzt auf {segment_id}.")
-                
-                # Startzeit und Rundenzähler: Für Tokens im Startsegment.
-                if segment_id.startswith("start-and-goal"):
-                    if client.hget(start_times_hash, token) is None:
-                        client.hset(start_times_hash, token, time.time())
-                    current = client.hget(rounds_hash, token)
-                    if current is None:
-                        current = 1
-                    else:
-                        current = int(current) + 1
-                    client.hset(rounds_hash, token, current)
-                    print(f"[{segment_id}] Token {token} Runde: {current}")
-                    if current > max_rounds:
-                        finish_time = time.time()
-                        start_time = client.hget(start_times_hash, token)
-                        runtime = finish_time - float(start_time) if start_time else 0
-                        print(f"[{segment_id}] Token {token} hat das Rennen beendet. Gesamtzeit: {runtime:.2f} Sekunden")
-                        # Speichere das Gesamtlaufzeit-Ergebnis in einem separaten Hash (optional).
-                        client.hset("race_results", token, runtime)
-                        client.incr("finished_tokens")
-                        # Lösche die Nachricht, damit sie nicht erneut verarbeitet wird.
-                        client.xdel(stream_name, entry_id)
-                        continue
-                
-                # Simuliere die Bearbeitungszeit im Segment (zufälliges Delay).
-                delay = random.uniform(0.5, 2.0)
-                print(f"[{segment_id}] Bearbeitung für {delay:.2f} Sekunden...")
-                seg_start = time.time()
-                time.sleep(delay)
-                seg_duration = time.time() - seg_start
-                # Pro Segment wird die verstrichene Zeit in einer Liste protokolliert.
-                client.rpush(f"race_results:{token}", f"{segment_id}:{seg_duration}")
-                print(f"[{segment_id}] Token {token} verbrachte {seg_duration:.2f} Sekunden in diesem Segment.")
-                
-                # Leite das Token an alle folgenden Segmente weiter.
-                for nxt in next_segments:
-                    next_lock = f"lock:{nxt}"
-                    while client.get(next_lock) is not None:
-                        time.sleep(0.1)
-                    client.xadd(f"stream-{nxt}", {"token": token})
-                    print(f"[{segment_id}] Token {token} weitergeleitet an {nxt}.")
-                
-                # Lösche diese Nachricht aus dem Stream, damit sie nicht erneut verarbeitet wird.
-                client.xdel(stream_name, entry_id)
+        if next_trim is not None and time.time() >= next_trim:
+            next_trim = time.time() + trim_interval
+            trim_streams(client, [segment])
+        if time.time() >= next_renew:
+            next_renew = time.time() + lease_ttl / LEASE_RENEW_DIVISOR
+            segment.renew_leases()
+        pipe = client.pipeline()
+        if next_sweep is not None and time.time() >= next_sweep and scheduler.free(segment) > 0:
+            next_sweep = time.time() + recovery_interval
+            receive(pipe, sweep(client, [segment], scheduler, recovery_idle)[0])
+        free = scheduler.free(segment)
+        deadline = scheduler.next_deadline()
+        if free > 0:
+            # Lese höchstens so viele Nachrichten, wie das Segment noch aufnehmen kann. Blockiert
+            # wird nur bis zum Ablauf des nächsten Tokens bzw. bis zur nächsten Suche nach
+            # liegengebliebenen Einträgen, zum nächsten Kürzen des Streams oder zum Verlängern der
+            # Leases (ohne alles unbegrenzt).
+            # Einträge, die nicht aufgenommen werden, bleiben im Stream und gehen nicht verloren.
+            wake = min((t for t in (deadline, next_sweep, next_trim) if t is not None), default=None)
+            if segment.held_leases:
+                wake = next_renew if wake is None else min(wake, next_renew)
+            block = 0 if wake is None else max(1, int((wake - time.time()) * 1000))
+            batch = segment.read(min(free, batch_size), block)
+            if batch:
+                receive(pipe, batch)
+        elif deadline is not None:
+            time.sleep(max(0.0, min(deadline, next_renew) - time.time()))
+        
+        # Alle fertigen Tokens weiterleiten; alle Schreibzugriffe des Durchlaufs in einer Pipeline.
+        # Vor dem Weiterleiten an ein Segment mit Zulassungskontrolle wird blockierend auf eine Lease
+        # gewartet; die Leases der Tokens im Segment werden dabei nach jeder Warterunde verlängert.
+        load_view.refresh_if_due()
+        departures = route_departures(scheduler.release_expired(time.time()), load_view)
+        for departure in departures:
+            lease = (segment.acquire_lease(departure.target, departure.token, on_wait=segment.renew_leases)
+                     if scheduler.needs_admission(departure) else None)
+            segment.leave(pipe, departure, lease)
+        flush(pipe)
+        scheduler.left(departures)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -80,8 +992,51 @@ if __name__ == "__main__":
     parser.add_argument("--redis-host", default="redis", help="Hostname des Redis-Clusters (Standard: 'redis').")
     parser.add_argument("--redis-port", type=int, default=6379, help="Port des Redis-Clusters (Standard: 6379).")
     parser.add_argument("--max-rounds", type=int, default=3, help="Maximale Runden, bevor ein Token als fertig gilt (Standard: 3).")
+    parser.add_argument("--consumer", default=None, help="Name dieses Consumers in der Consumer Group (Standard: Hostname).")
+    parser.add_argument("--batch-size", type=int, default=10, help="Maximale Anzahl an Einträgen pro XREADGROUP-Aufruf (Standard: 10).")
+    parser.add_argument("--segment-type", default="normal", help="Typ des Segments aus tracks.json (Standard: 'normal').")
+    parser.add_argument("--capacity", type=int, default=None,
+                        help=f"Maximale Anzahl gleichzeitig bearbeiteter Tokens (Standard: 1 für Bottlenecks, sonst {DEFAULT_CAPACITY}).")
+    parser.add_argument("--clock", choices=CLOCK_MODES, default="wall",
+                        help="'wall' wartet die Bearbeitungszeit real ab, 'virtual' rechnet näherungsweise mit der virtuellen Zeit der Nachrichten (Standard: 'wall').")
+    parser.add_argument("--gated-next", default="",
+                        help="Kommagetrennte Liste der nächsten Segmente mit Zulassungskontrolle (verteilter Semaphor).")
+    parser.add_argument("--lease-ttl", type=float, default=LEASE_TTL,
+                        help=f"Gültigkeit einer Semaphor-Lease in Sekunden, danach verfällt sie z.B. nach einem Absturz (Standard: {LEASE_TTL}).")
+    parser.add_argument("--routing", choices=ROUTING_POLICIES, default=DEFAULT_ROUTING,
+                        help=f"Auswahl des nächsten Segments bei Verzweigungen (Standard: '{DEFAULT_ROUTING}').")
+    parser.add_argument("--weights", default="",
+                        help="Kommagetrennte Gewichte für --routing weighted, in der Reihenfolge von --next.")
+    parser.add_argument("--load-refresh-interval", type=float, default=LOAD_REFRESH_INTERVAL,
+                        help=f"Abstand in Sekunden, in dem least-loaded die Rückstände neu liest (Standard: {LOAD_REFRESH_INTERVAL}).")
+    parser.add_argument("--load-max-staleness", type=float, default=LOAD_MAX_STALENESS,
+                        help=f"Maximales Alter der Rückstände in Sekunden, danach wird zufällig verteilt (Standard: {LOAD_MAX_STALENESS}).")
+    parser.add_argument("--key-layout", choices=KEY_LAYOUTS, default=DEFAULT_KEY_LAYOUT,
+                        help=f"Namensschema der Redis-Keys, muss im ganzen Rennen gleich sein (Standard: '{DEFAULT_KEY_LAYOUT}').")
+    parser.add_argument("--state-buckets", type=int, default=DEFAULT_STATE_BUCKETS,
+                        help=f"Buckets pro Track für den Token-Zustand, muss im ganzen Rennen gleich sein (Standard: {DEFAULT_STATE_BUCKETS}).")
+    parser.add_argument("--project-state", action=argparse.BooleanOptionalAction, default=PROJECT_STATE,
+                        help="Runden, Startzeiten und Standorte zusätzlich in token_rounds/token_start_times/token_locations schreiben.")
+    parser.add_argument("--message-format", type=int, choices=MESSAGE_FORMATS, default=DEFAULT_MESSAGE_FORMAT,
+                        help=f"Format der geschriebenen Nachrichten und Segmentzeiten, 2 = kompakt (Standard: {DEFAULT_MESSAGE_FORMAT}).")
+    parser.add_argument("--segment-index", type=int, default=None,
+                        help="Nummer des Segments in der Segmenttabelle des Race-Managers (für --message-format 2).")
+    parser.add_argument("--recovery-idle", type=float, default=RECOVERY_IDLE,
+                        help=f"Einträge anderer Consumer, die so viele Sekunden unbestätigt sind, werden übernommen; 0 = aus (Standard: {RECOVERY_IDLE}).")
+    parser.add_argument("--recovery-interval", type=float, default=RECOVERY_INTERVAL,
+                        help=f"Abstand in Sekunden zwischen zwei Suchen nach liegengebliebenen Einträgen (Standard: {RECOVERY_INTERVAL}).")
+    parser.add_argument("--trim-interval", type=float, default=TRIM_INTERVAL,
+                        help=f"Abstand in Sekunden, in dem der Stream bis zum ältesten unbestätigten Eintrag gekürzt wird; 0 = aus (Standard: {TRIM_INTERVAL}).")
+    parser.add_argument("--stream-maxlen", type=int, default=STREAM_MAXLEN,
+                        help=f"Ungefähre Obergrenze (MAXLEN ~) für die Streams der nächsten Segmente; 0 = keine (Standard: {STREAM_MAXLEN}).")
     args = parser.parse_args()
     
     next_segments = [s.strip() for s in args.next.split(",") if s.strip()]
-    process_segment(args.segment_id, next_segments, args.redis_host, args.redis_port, args.max_rounds)
-
+    gated_next = [s.strip() for s in args.gated_next.split(",") if s.strip()]
+    weights = [float(w) for w in args.weights.split(",") if w.strip()] or None
+    process_segment(args.segment_id, next_segments, args.redis_host, args.redis_port, args.max_rounds,
+                    args.consumer, args.batch_size, args.segment_type, args.capacity, args.clock, gated_next,
+                    args.lease_ttl, args.routing, weights, args.load_refresh_interval, args.load_max_staleness,
+                    args.key_layout, args.state_buckets, args.project_state, args.message_format,
+                    args.segment_index, args.recovery_idle, args.recovery_interval, args.trim_interval,
+                    args.stream_maxlen)
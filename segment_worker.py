@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Asyncio-Worker, der viele Segmente in einem Prozess mit einem gemeinsamen
+Redis-Cluster-Client betreibt. Neue Einträge werden für alle Segmente mit freier
+Kapazität in einer Pipeline gelesen, alle Tokens liegen in einem gemeinsamen
+Timer-Heap, gewartet wird mit asyncio.sleep und die blockierenden Redis-Aufrufe
+laufen in einem Thread-Pool.
+
+Mit --warm bleibt der Worker über viele Rennen hinweg bestehen und erhält seine Segmente
+und Einstellungen pro Rennen über den Steuer-Stream CONTROL_STREAM (siehe serve_races).
+"""
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from segment_program import (CLOCK_MODES, DEFAULT_KEY_LAYOUT, DEFAULT_MESSAGE_FORMAT, DEFAULT_ROUTING,
+                             DEFAULT_STATE_BUCKETS, KEY_LAYOUTS, LEASE_RENEW_DIVISOR, LEASE_TTL, LOAD_MAX_STALENESS,
+                             LOAD_REFRESH_INTERVAL,
+                             MESSAGE_FORMATS, PROJECT_STATE, RECOVERY_IDLE, RECOVERY_INTERVAL, STREAM_MAXLEN,
+                             TRIM_INTERVAL, Keyspace, Segment, StreamLoadView, TokenScheduler, create_client,
+                             deduplicate, flush, route_departures, sweep, trim_streams)
+
+# Steuer-Stream der warmen Worker: Der Race-Manager legt pro Rennen einen Start-Befehl (mit
+# Segmenten und Einstellungen) und einen Stopp-Befehl ab. Die Worker melden ihren Zustand
+# ("<rennen>:ready", "<rennen>:stopped", "<rennen>:failed") im Hash WORKER_STATUS_KEY.
+CONTROL_STREAM = "{control}:races"
+WORKER_STATUS_KEY = "{control}:workers"
+CONTROL_MAXLEN = 100  # Ungefähre Länge, auf die der Steuer-Stream beim XADD gekürzt wird.
+CONTROL_BLOCK = 1.0  # Sekunden, die ein warmer Worker höchstens auf neue Steuerbefehle wartet.
+# Obergrenze der Wartezeit zwischen zwei Lesevorgängen ohne neue Einträge: Die Wartezeit beginnt
+# bei --poll-interval und verdoppelt sich mit jedem leeren Durchlauf bis zu diesem Wert.
+MAX_POLL_INTERVAL = 1.0
+# Sekunden bis zum nächsten Versuch, wenn das Weiterleiten nach dem Warten auf eine Lease fehlschlägt.
+FORWARD_RETRY_DELAY = 1.0
+
+def read_all(client, segments, counts):
+    """Liest für alle übergebenen Segmente neue Einträge in einer Pipeline."""
+    pipe = client.pipeline()
+    for segment, count in zip(segments, counts):
+        segment.queue_read(pipe, count)
+    return [segment.parse_read(reply) for segment, reply in zip(segments, pipe.execute())]
+
+def admit_all(client, scheduler, segments, batches, dedup=False):
+    """
+    Setzt Standorte und nimmt die gelesenen Tokens aller Segmente in den Timer-Heap auf;
+    mit dedup werden doppelte Zustellungen vorher verworfen.
+    """
+    if dedup:
+        batches = deduplicate(client, segments, batches)
+    pipe = client.pipeline()
+    now = time.time()
+    for segment, batch in zip(segments, batches):
+        if batch:
+            segment.queue_received(pipe, batch)
+            scheduler.admit(segment, pipe, batch, now)
+    flush(pipe)
+
+def leave_all(client, departures, lease=None):
+    """Leitet die übergebenen Tokens in einer gemeinsamen Pipeline weiter."""
+    pipe = client.pipeline()
+    for departure in departures:
+        departure.segment.leave(pipe, departure, lease)
+    flush(pipe)
+
+def renew_all(segments):
+    """Verlängert die Leases der Tokens in allen übergebenen Segmenten."""
+    for segment in segments:
+        if segment.held_leases:
+            segment.renew_leases()
+
+def create_segments(client, segments, max_rounds=3, consumer_name=None, lease_ttl=LEASE_TTL, keyspace=None,
+                    project_state=PROJECT_STATE, message_format=DEFAULT_MESSAGE_FORMAT, stream_maxlen=STREAM_MAXLEN):
+    """Erzeugt die Segmente aus ihrer Beschreibung im Format von tracks.json (siehe --segments)."""
+    return [Segment(client, seg["segmentId"], seg["nextSegments"], max_rounds, consumer_name,
+                    seg.get("type", "normal"), seg.get("capacity"), seg.get("gatedNext", ()), lease_ttl,
+                    seg.get("routing", DEFAULT_ROUTING), seg.get("weights"), keyspace,
+                    project_state, message_format, seg.get("index"), stream_maxlen)
+            for seg in segments]
+
+async def forward_when_admitted(executor, client, departure, cancelled, forwarded):
+    """
+    Wartet auf eine Lease im zulassungskontrollierten Zielsegment und leitet das Token danach
+    weiter. Das Warten belegt nur einen Thread des Zulassungs-Pools, nicht den Event-Loop;
+    nach dem Setzen von cancelled (Abbruch des Workers) gibt der Thread das Warten auf.
+    Weitergeleitete Tokens landen in forwarded; ihre Plätze gibt run_worker frei.
+    Schlägt ein Redis-Zugriff fehl, wird nach FORWARD_RETRY_DELAY Sekunden erneut versucht, denn
+    den eigenen unbestätigten Eintrag liest der Worker nicht noch einmal (das Token ginge verloren).
+    Eine bereits belegte Lease wird dabei weiterverwendet.
+    """
+    loop = asyncio.get_running_loop()
+    lease = None
+    while not cancelled.is_set():
+        try:
+            if lease is None:
+                lease = await loop.run_in_executor(executor, departure.segment.acquire_lease, departure.target,
+                                                   departure.token, cancelled)
+                if lease is None:
+                    return
+            await loop.run_in_executor(executor, leave_all, client, [departure], lease)
+            forwarded.append(departure)
+            return
+        except Exception as e:
+            print(f"[{departure.segment.segment_id}] Weiterleiten von Token {departure.token} an {departure.target} "
+                  f"fehlgeschlagen ({e!r}), neuer Versuch in {FORWARD_RETRY_DELAY} Sekunden.")
+            await asyncio.sleep(FORWARD_RETRY_DELAY)
+
+async def run_worker(client, segments, batch_size=10, poll_interval=0.1, threads=16, clock="wall",
+                     admission_threads=64, load_refresh_interval=LOAD_REFRESH_INTERVAL,
+                     load_max_staleness=LOAD_MAX_STALENESS, recovery_idle=RECOVERY_IDLE,
+                     recovery_interval=RECOVERY_INTERVAL, trim_interval=TRIM_INTERVAL,
+                     max_poll_interval=MAX_POLL_INTERVAL, on_ready=None):
+    """
+    Betreibt die Segmente, bis der Task abgebrochen wird. on_ready wird (im Thread-Pool) aufgerufen,
+    sobald die Consumer Groups aller Segmente angelegt sind.
+    """
+    if not segments:
+        raise ValueError("Der Worker braucht mindestens ein Segment.")
+    executor = ThreadPoolExecutor(max_workers=threads)
+    # Eigener Pool für das blockierende Warten auf Leases, damit wartende Tokens die übrigen Segmente nicht aufhalten.
+    admission_executor = ThreadPoolExecutor(max_workers=admission_threads)
+    # Tasks, die auf Leases warten (Referenzen halten, damit sie nicht eingesammelt werden).
+    waiting = set()
+    # Beendet beim Abbrechen auch die Threads, die noch auf eine Lease warten.
+    cancelled = threading.Event()
+    try:
+        loop = asyncio.get_running_loop()
+        for segment in segments:
+            await loop.run_in_executor(executor, segment.setup)
+        print(f"Worker gestartet mit {len(segments)} Segmenten: {', '.join(s.segment_id for s in segments)}")
+        if on_ready is not None:
+            await loop.run_in_executor(executor, on_ready)
+
+        # Ein gemeinsamer Timer-Heap für alle Segmente dieses Workers.
+        scheduler = TokenScheduler(virtual=(clock == "virtual"))
+        # Gemeinsame, periodisch aufgefrischte Sicht auf die Rückstände für least-loaded-Routing.
+        load_view = StreamLoadView(client, segments, segments[0].consumer_name, load_refresh_interval, load_max_staleness,
+                                   segments[0].keyspace)
+        next_sweep = time.time()
+        next_trim = time.time() + trim_interval
+        # Die Leases der Tokens in den Segmenten werden regelmäßig verlängert, auch während die
+        # Tokens in den Threads des Zulassungs-Pools auf die Lease des nächsten Segments warten.
+        renew_interval = min(s.lease_ttl for s in segments) / LEASE_RENEW_DIVISOR
+        next_renew = time.time() + renew_interval
+        # Aufeinanderfolgende Durchläufe ohne neue Einträge und ohne weitergeleitete Tokens; ein nach
+        # dem Warten auf eine Lease weitergeleitetes Token weckt die Schleife über wake.
+        idle_rounds = 0
+        wake = asyncio.Event()
+        # Nach dem Warten auf eine Lease weitergeleitete Tokens, deren Plätze noch freizugeben sind.
+        # Freigegeben wird nur hier in der Schleife, nie während admit_all im Thread-Pool den
+        # Scheduler ändert.
+        forwarded = []
+        while True:
+            scheduler.left(forwarded)
+            forwarded.clear()
+
+            # Bestätigte Einträge aus den Streams aller Segmente entfernen.
+            if trim_interval > 0 and time.time() >= next_trim:
+                next_trim = time.time() + trim_interval
+                await loop.run_in_executor(executor, trim_streams, client, segments)
+
+            if time.time() >= next_renew:
+                next_renew = time.time() + renew_interval
+                await loop.run_in_executor(executor, renew_all, segments)
+
+            # Liegengebliebene Einträge abgestürzter Consumer übernehmen.
+            if recovery_idle > 0 and time.time() >= next_sweep:
+                next_sweep = time.time() + recovery_interval
+                sweepable = [s for s in segments if scheduler.free(s) > 0]
+                if sweepable:
+                    claimed = await loop.run_in_executor(executor, sweep, client, sweepable, scheduler, recovery_idle)
+                    if any(claimed):
+                        await loop.run_in_executor(executor, admit_all, client, scheduler, sweepable, claimed, True)
+
+            # Nur Segmente mit freier Kapazität lesen, und höchstens so viele Einträge, wie sie aufnehmen können.
+            readable = [s for s in segments if scheduler.free(s) > 0]
+            counts = [min(batch_size, scheduler.free(s)) for s in readable]
+            received = False
+            if readable:
+                batches = await loop.run_in_executor(executor, read_all, client, readable, counts)
+                received = any(batches)
+                if received:
+                    await loop.run_in_executor(executor, admit_all, client, scheduler, readable, batches,
+                                               recovery_idle > 0)
+
+            # Fertige Tokens weiterleiten: ohne Zulassungskontrolle gesammelt in einer Pipeline,
+            # sonst jeweils in einem eigenen Task, sobald die nötigen Leases vergeben sind.
+            if load_view.due(time.time()):
+                await loop.run_in_executor(executor, load_view.refresh)
+            departures = route_departures(scheduler.release_expired(time.time()), load_view)
+            ready = [d for d in departures if not scheduler.needs_admission(d)]
+            for departure in departures:
+                if scheduler.needs_admission(departure):
+                    task = asyncio.create_task(forward_when_admitted(admission_executor, client, departure, cancelled,
+                                                                     forwarded))
+                    waiting.add(task)
+                    task.add_done_callback(waiting.discard)
+                    task.add_done_callback(lambda _: wake.set())
+            if ready:
+                await loop.run_in_executor(executor, leave_all, client, ready)
+                scheduler.left(ready)
+
+            # Ohne neue Einträge bis zum nächsten fertigen Token warten, höchstens aber poll_interval,
+            # das sich bei jedem leeren Durchlauf bis max_poll_interval verdoppelt: Ein untätiger
+            # Worker fragt so nur noch etwa einmal pro max_poll_interval alle Streams ab. Dafür
+            # wird ein Token, das einen untätigen Worker erreicht, bis zu max_poll_interval später gelesen.
+            idle_rounds = 0 if received or departures else idle_rounds + 1
+            delay = 0 if received else min(max_poll_interval, poll_interval * 2 ** max(0, min(idle_rounds - 1, 16)))
+            deadline = scheduler.next_deadline()
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - time.time()))
+            delay = min(delay, max(0.0, next_renew - time.time()))
+            try:
+                await asyncio.wait_for(wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            if wake.is_set():
+                wake.clear()
+                idle_rounds = 0
+    finally:
+        # Beim Abbrechen (z.B. ein warmer Worker vor dem nächsten Rennen) auch die auf Leases
+        # wartenden Tasks und Threads beenden und die Pools freigeben, statt sie pro Rennen
+        # anzuhäufen. Gewartet wird, bis kein Thread mehr auf Redis zugreift: Erst danach darf
+        # der Race-Manager die Keys des Rennens löschen, ohne dass sie neu angelegt werden.
+        cancelled.set()
+        for task in list(waiting):
+            task.cancel()
+        admission_executor.shutdown(wait=False, cancel_futures=True)
+
+        def shutdown():
+            executor.shutdown(wait=True)
+            admission_executor.shutdown(wait=True)
+        await asyncio.get_running_loop().run_in_executor(None, shutdown)
+
+def publish_control(client, race, action, config=None):
+    """Legt einen Steuerbefehl für alle warmen Worker ab: "start" (mit config) oder "stop" eines Rennens."""
+    fields = {"race": race, "action": action}
+    if config is not None:
+        fields["config"] = json.dumps(config)
+    return client.xadd(CONTROL_STREAM, fields, maxlen=CONTROL_MAXLEN, approximate=True)
+
+def read_control(client, last_id, block=CONTROL_BLOCK):
+    """
+    Liest die Steuerbefehle nach last_id und wartet dabei höchstens block Sekunden. Ohne last_id
+    wird nur der jüngste Befehl geliefert, damit ein neu gestarteter Worker in ein laufendes Rennen einsteigt.
+    """
+    if last_id is None:
+        return client.xrevrange(CONTROL_STREAM, count=1)
+    reply = client.xread({CONTROL_STREAM: last_id}, block=max(1, int(block * 1000)))
+    return [entry for _, entries in reply or [] for entry in entries]
+
+def report_status(client, worker_name, race, state):
+    """Meldet den Zustand des Workers für ein Rennen in WORKER_STATUS_KEY."""
+    client.hset(WORKER_STATUS_KEY, worker_name, f"{race}:{state}")
+
+def start_race_worker(client, worker_name, race, config, batch_size, poll_interval, threads, admission_threads,
+                      max_poll_interval=MAX_POLL_INTERVAL):
+    """
+    Erzeugt die Segmente dieses Workers aus einem Start-Befehl (im Namensraum des Rennens) und
+    startet run_worker als Task. Ohne zugewiesene Segmente meldet der Worker nur seine Bereitschaft.
+    """
+    def ready():
+        report_status(client, worker_name, race, "ready")
+
+    assigned = config["segments"].get(worker_name, [])
+    if not assigned:
+        ready()
+        return None
+    keyspace = Keyspace(config.get("key_layout", DEFAULT_KEY_LAYOUT), config.get("state_buckets", DEFAULT_STATE_BUCKETS),
+                        race)
+    segments = create_segments(client, assigned, config.get("max_rounds", 3), worker_name,
+                               config.get("lease_ttl", LEASE_TTL), keyspace, config.get("project_state", PROJECT_STATE),
+                               config.get("message_format", DEFAULT_MESSAGE_FORMAT),
+                               config.get("stream_maxlen", STREAM_MAXLEN))
+    return asyncio.create_task(run_worker(client, segments, batch_size, poll_interval, threads,
+                                          config.get("clock", "wall"), admission_threads,
+                                          recovery_idle=config.get("recovery_idle", RECOVERY_IDLE),
+                                          trim_interval=config.get("trim_interval", TRIM_INTERVAL),
+                                          max_poll_interval=max_poll_interval, on_ready=ready))
+
+async def serve_races(client, worker_name, batch_size=10, poll_interval=0.1, threads=16, admission_threads=64,
+                      max_poll_interval=MAX_POLL_INTERVAL):
+    """
+    Warmer Worker: läuft über viele Rennen hinweg und wird über CONTROL_STREAM umkonfiguriert, statt
+    für jedes Rennen einen neuen Container zu starten. Ein Start-Befehl beendet das laufende Rennen
+    und startet die im Befehl für worker_name aufgeführten Segmente, ein Stopp-Befehl beendet das
+    Rennen. Nach dem Anlegen der Consumer Groups bzw. dem Beenden wird der Zustand gemeldet.
+    """
+    loop = asyncio.get_running_loop()
+    control_executor = ThreadPoolExecutor(max_workers=1)
+    print(f"Warmer Worker {worker_name} wartet auf Steuerbefehle in {CONTROL_STREAM}.")
+    current, current_race, last_id = None, None, None
+    while True:
+        entries = await loop.run_in_executor(control_executor, read_control, client, last_id)
+        last_id = last_id or "0-0"
+        if current is not None and current.done() and not current.cancelled() and current.exception():
+            print(f"Rennen {current_race} in Worker {worker_name} abgebrochen: {current.exception()!r}")
+            await loop.run_in_executor(control_executor, report_status, client, worker_name, current_race, "failed")
+            current = None
+        for entry_id, fields in entries:
+            last_id = entry_id
+            if current is not None:
+                current.cancel()
+                await asyncio.gather(current, return_exceptions=True)
+                current = None
+            race, action = fields["race"], fields["action"]
+            if action == "start":
+                print(f"Starte Rennen {race}.")
+                current = start_race_worker(client, worker_name, race, json.loads(fields["config"]), batch_size,
+                                            poll_interval, threads, admission_threads, max_poll_interval)
+            elif action == "stop":
+                await loop.run_in_executor(control_executor, report_status, client, worker_name, race, "stopped")
+            current_race = race
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Worker-Prozess, der mehrere Segmente gleichzeitig mit asyncio betreibt."
+    )
+    parser.add_argument("--segments", default=None,
+                        help="JSON-Liste der Segmente im Format von tracks.json (segmentId, type, nextSegments, "
+                             "optional capacity, routing, weights, gatedNext und index).")
+    parser.add_argument("--redis-host", default="redis", help="Hostname des Redis-Clusters (Standard: 'redis').")
+    parser.add_argument("--redis-port", type=int, default=6379, help="Port des Redis-Clusters (Standard: 6379).")
+    parser.add_argument("--max-rounds", type=int, default=3, help="Maximale Runden, bevor ein Token als fertig gilt (Standard: 3).")
+    parser.add_argument("--consumer", default=None,
+                        help="Name dieses Consumers in den Consumer Groups, mit --warm auch Name des Workers im Steuer-Stream (Standard: Hostname).")
+    parser.add_argument("--warm", action="store_true",
+                        help=f"Über viele Rennen laufen und Segmente sowie Einstellungen aus {CONTROL_STREAM} übernehmen (statt --segments und der Renn-Optionen).")
+    parser.add_argument("--batch-size", type=int, default=10, help="Maximale Anzahl an Einträgen pro Segment und Lesevorgang (Standard: 10).")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="Wartezeit in Sekunden, wenn keine neuen Einträge vorliegen (Standard: 0.1).")
+    parser.add_argument("--max-poll-interval", type=float, default=MAX_POLL_INTERVAL,
+                        help=f"Obergrenze, bis zu der sich die Wartezeit bei leeren Lesevorgängen verdoppelt (Standard: {MAX_POLL_INTERVAL}).")
+    parser.add_argument("--threads", type=int, default=16, help="Größe des Thread-Pools für Redis-Aufrufe (Standard: 16).")
+    parser.add_argument("--admission-threads", type=int, default=64,
+                        help="Größe des Thread-Pools für das Warten auf Leases (Standard: 64).")
+    parser.add_argument("--lease-ttl", type=float, default=LEASE_TTL,
+                        help=f"Gültigkeit einer Semaphor-Lease in Sekunden (Standard: {LEASE_TTL}).")
+    parser.add_argument("--load-refresh-interval", type=float, default=LOAD_REFRESH_INTERVAL,
+                        help=f"Abstand in Sekunden, in dem least-loaded die Rückstände neu liest (Standard: {LOAD_REFRESH_INTERVAL}).")
+    parser.add_argument("--load-max-staleness", type=float, default=LOAD_MAX_STALENESS,
+                        help=f"Maximales Alter der Rückstände in Sekunden, danach wird zufällig verteilt (Standard: {LOAD_MAX_STALENESS}).")
+    parser.add_argument("--clock", choices=CLOCK_MODES, default="wall",
+                        help="'wall' wartet die Bearbeitungszeit real ab, 'virtual' rechnet näherungsweise mit der virtuellen Zeit der Nachrichten (Standard: 'wall').")
+    parser.add_argument("--key-layout", choices=KEY_LAYOUTS, default=DEFAULT_KEY_LAYOUT,
+                        help=f"Namensschema der Redis-Keys, muss im ganzen Rennen gleich sein (Standard: '{DEFAULT_KEY_LAYOUT}').")
+    parser.add_argument("--state-buckets", type=int, default=DEFAULT_STATE_BUCKETS,
+                        help=f"Buckets pro Track für den Token-Zustand, muss im ganzen Rennen gleich sein (Standard: {DEFAULT_STATE_BUCKETS}).")
+    parser.add_argument("--project-state", action=argparse.BooleanOptionalAction, default=PROJECT_STATE,
+                        help="Runden, Startzeiten und Standorte zusätzlich in token_rounds/token_start_times/token_locations schreiben.")
+    parser.add_argument("--message-format", type=int, choices=MESSAGE_FORMATS, default=DEFAULT_MESSAGE_FORMAT,
+                        help=f"Format der geschriebenen Nachrichten und Segmentzeiten, 2 = kompakt (Standard: {DEFAULT_MESSAGE_FORMAT}).")
+    parser.add_argument("--recovery-idle", type=float, default=RECOVERY_IDLE,
+                        help=f"Einträge anderer Consumer, die so viele Sekunden unbestätigt sind, werden übernommen; 0 = aus (Standard: {RECOVERY_IDLE}).")
+    parser.add_argument("--recovery-interval", type=float, default=RECOVERY_INTERVAL,
+                        help=f"Abstand in Sekunden zwischen zwei Suchen nach liegengebliebenen Einträgen (Standard: {RECOVERY_INTERVAL}).")
+    parser.add_argument("--trim-interval", type=float, default=TRIM_INTERVAL,
+                        help=f"Abstand in Sekunden, in dem die Streams bis zum ältesten unbestätigten Eintrag gekürzt werden; 0 = aus (Standard: {TRIM_INTERVAL}).")
+    parser.add_argument("--stream-maxlen", type=int, default=STREAM_MAXLEN,
+                        help=f"Ungefähre Obergrenze (MAXLEN ~) für die Streams der nächsten Segmente; 0 = keine (Standard: {STREAM_MAXLEN}).")
+    args = parser.parse_args()
+    if not args.warm and args.segments is None:
+        parser.error("--segments ist ohne --warm erforderlich.")
+    if not args.warm and not json.loads(args.segments):
+        parser.error("--segments enthält keine Segmente.")
+
+    client = create_client(args.redis_host, args.redis_port)
+    if args.warm:
+        asyncio.run(serve_races(client, args.consumer or socket.gethostname(), args.batch_size, args.poll_interval,
+                                args.threads, args.admission_threads, args.max_poll_interval))
+    else:
+        keyspace = Keyspace(args.key_layout, args.state_buckets)
+        segments = create_segments(client, json.loads(args.segments), args.max_rounds, args.consumer, args.lease_ttl,
+                                   keyspace, args.project_state, args.message_format, args.stream_maxlen)
+        asyncio.run(run_worker(client, segments, args.batch_size, args.poll_interval, args.threads, args.clock,
+                               args.admission_threads, args.load_refresh_interval, args.load_max_staleness,
+                               args.recovery_idle, args.recovery_interval, args.trim_interval,
+                               args.max_poll_interval))